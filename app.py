@@ -1,149 +1,83 @@
+import os
 import streamlit as st
-import random
-from datetime import datetime
 from playback_controller import PlaybackController
 from loopgen import LoopGen
+from loop_cache import DEFAULT_CACHE_DIR, LoopCache
+from music_params import CATALOG_VARIANTS, GOALS, STYLES, derive_seed, generate_music_parameters
+from sf2_subset import style_soundfont
+from telemetry import Telemetry
+
+LIVE_REFRESH_SECONDS = 1.0  # Poll interval of the live panel while playing
 
 # ---- Session State Initialization ----
 if "playback_controller" not in st.session_state:
-    st.session_state.playback_controller = PlaybackController()
+    st.session_state.playback_controller = PlaybackController(
+        cache=LoopCache(directory=DEFAULT_CACHE_DIR),
+        telemetry=Telemetry(export_path=os.environ.get("MOODRING_METRICS_FILE")),  # *.prom or JSONL
+    )
 if "current_loop_params" not in st.session_state:
     st.session_state.current_loop_params = {}
+if "params_selection" not in st.session_state:
+    st.session_state.params_selection = None  # (goal, style, hour) the current params were made for
 if "simulated_hour" not in st.session_state:
     st.session_state.simulated_hour = 7  # Start day at 7 AM
-if "event_log" not in st.session_state:
-    st.session_state.event_log = []
-
-# ---- Constants ----
-GOALS = ["Focus", "Relax", "Energy", "Sleep", "Creative Flow", "Calm Confidence", "Romantic", "Reflective"]
-STYLES = ["Ambient", "Jazz", "Classical", "Electronic/EDM", "Pop", "World", "Folk/Acoustic", "Cinematic/Orchestral"]
-
-BPM_RANGES = {
-    "Focus": {"Morning": (90, 110), "Midday": (100, 120), "Evening": (80, 100), "Night": (60, 80)},
-    "Relax": {"Morning": (70, 90), "Midday": (80, 100), "Evening": (60, 80), "Night": (40, 60)},
-    "Energy": {"Morning": (100, 120), "Midday": (120, 140), "Evening": (110, 130), "Night": (90, 110)},
-    "Sleep": {"Evening": (50, 70), "Night": (40, 60)},
-    "Creative Flow": {"Morning": (90, 110), "Midday": (100, 120), "Evening": (80, 100)},
-    "Calm Confidence": {"Morning": (80, 100), "Midday": (90, 110), "Evening": (70, 90)},
-    "Romantic": {"Evening": (60, 80), "Night": (50, 70)},
-    "Reflective": {"Evening": (60, 80), "Night": (50, 70)}
-}
-
-CHORD_PROGRESSIONS = {
-    "Focus": ["I-vi-IV-V", "ii-V-I", "Modal Dorian"],
-    "Relax": ["I-IV-I", "I-vi-IV-I", "Lydian Static"],
-    "Energy": ["I-V-vi-IV", "IV-V-I", "Dominant Cycle"],
-    "Sleep": ["I-ii-I", "Pedal Tones", "Open 5ths"],
-    "Creative Flow": ["I-V-vi-IV", "ii-V-I", "Modal Mixolydian"],
-    "Calm Confidence": ["I-IV-V-I", "ii-V-I", "I-vi-ii-V"],
-    "Romantic": ["I-vi-IV-V", "ii-V-I", "I-IV-I"],
-    "Reflective": ["I-vi-IV-I", "Modal Aeolian", "I-ii-IV-V"]
-}
-
-INSTRUMENT_SETS = {
-    "Ambient": [88, 90, 91, 94, 95, 81, 82],
-    "Jazz": [0, 1, 26, 27, 56, 57, 32, 33],
-    "Classical": [0, 48, 49, 50, 46],
-    "Electronic/EDM": [81, 82, 83, 88, 89, 90, 97, 98],
-    "Pop": [0, 1, 25, 26, 80, 81],
-    "World": [104, 105, 106, 73, 74, 115, 116],
-    "Folk/Acoustic": [24, 25, 26, 105, 22],
-    "Cinematic/Orchestral": [48, 49, 60, 61, 117, 118]
-}
-
-SCALE_MAP = {
-    "Focus": ["Dorian", "Mixolydian", "Major"],
-    "Relax": ["Lydian", "Major", "Pentatonic"],
-    "Energy": ["Major", "Mixolydian", "Phrygian"],
-    "Sleep": ["Aeolian", "Dorian", "Pentatonic"],
-    "Creative Flow": ["Lydian", "Mixolydian", "Dorian"],
-    "Calm Confidence": ["Major", "Dorian"],
-    "Romantic": ["Harmonic Minor", "Aeolian", "Major"],
-    "Reflective": ["Aeolian", "Dorian", "Pentatonic"]
-}
-
-KEY_MAP = {
-    "Focus": ["C", "A", "F"],
-    "Relax": ["F", "Eb", "Bb"],
-    "Energy": ["G", "D", "E"],
-    "Sleep": ["A Minor", "C Minor", "G Minor"],
-    "Creative Flow": ["E", "G", "D"],
-    "Calm Confidence": ["C", "F", "Bb"],
-    "Romantic": ["Bb", "D Minor", "A Minor"],
-    "Reflective": ["C Minor", "D Minor", "Eb", "G Minor"]
-}
-
-CIRCADIAN_KEY_BIAS = {
-    "Morning": ["C", "G", "F", "A"],
-    "Midday": ["D", "E", "G", "A"],
-    "Early Afternoon": ["E", "G", "A", "D"],
-    "Late Afternoon": ["F", "Bb", "Eb"],
-    "Evening": ["Bb", "Eb", "C Minor", "D Minor"],
-    "Night": ["A Minor", "C Minor", "G Minor", "D Minor"],
-    "Sleep": ["A Minor", "C Minor", "G Minor"]
-}
-
-# ---- Circadian Functions ----
-def get_circadian_phase(hour):
-    if 6 <= hour < 9:
-        return "Morning"
-    elif 9 <= hour < 12:
-        return "Midday"
-    elif 12 <= hour < 15:
-        return "Early Afternoon"
-    elif 15 <= hour < 18:
-        return "Late Afternoon"
-    elif 18 <= hour < 21:
-        return "Evening"
-    elif 21 <= hour < 24:
-        return "Night"
-    else:
-        return "Sleep"
-
-def select_biased_key(goal, phase):
-    goal_keys = KEY_MAP.get(goal, ["C"])
-    phase_keys = CIRCADIAN_KEY_BIAS.get(phase, ["C"])
-    common_keys = list(set(goal_keys) & set(phase_keys))
-    if common_keys:
-        return random.choice(common_keys)
-    combined_keys = goal_keys + phase_keys * 2
-    return random.choice(combined_keys)
-
-def generate_music_parameters(goal, style, hour):
-    phase = get_circadian_phase(hour)
-    bpm_range = BPM_RANGES.get(goal, {}).get(phase, (80, 100))
-    bpm = random.randint(*bpm_range)
-    phrase_length = random.choices([4, 8, 16], weights=[1, 3, 5])[0]
-    chosen_progression = " - ".join(random.choices(CHORD_PROGRESSIONS.get(goal, ["I-IV-V-I"]), k=phrase_length))
-    full_instrument_set = INSTRUMENT_SETS.get(style, [0])
-    chosen_instruments = random.sample(full_instrument_set, min(len(full_instrument_set), random.choice([3, 4])))
-    chosen_scale = random.choice(SCALE_MAP.get(goal, ["Major"]))
-    chosen_key = select_biased_key(goal, phase)
-
-    params = {
-        "simulated_hour": hour,
-        "circadian_phase": phase,
-        "bpm": bpm,
-        "chord_progression": chosen_progression,
-        "scale": chosen_scale,
-        "key": chosen_key,
-        "instruments": chosen_instruments,
-        "phrase_length": phrase_length
-    }
-
-    st.session_state.current_loop_params = params
-    return params
-
-def update_ui_event_log():
-    controller_log = st.session_state.playback_controller.event_log
-    st.session_state.event_log = controller_log.copy()
-
-def display_timeline():
+
+# ---- Parameter Selection ----
+def generate_loop_parameters(goal, style, hour, seed=None):
+    # Params stay fixed across reruns until the goal, style or hour changes.
+    selection = (goal, style, hour)
+    if st.session_state.params_selection != selection:
+        st.session_state.current_loop_params = generate_music_parameters(goal, style, hour, seed)
+        st.session_state.params_selection = selection
+    return st.session_state.current_loop_params
+
+def params_generator(goal, style, simulated_hour):
+    # Runs on the playback thread, so it must not touch st.session_state.
+    current_hour = simulated_hour
+    loop_index = 0
+    while True:
+        # Seeds cycle through a fixed set of variants per hour, so repeat
+        # sessions are served from the loop cache.
+        variant = (loop_index // 24) % CATALOG_VARIANTS
+        yield generate_music_parameters(goal, style, current_hour, derive_seed(goal, style, current_hour, variant))
+        current_hour = (current_hour + 1) % 24
+        loop_index += 1
+
+def shift_hour(delta):
+    st.session_state.simulated_hour = (st.session_state.simulated_hour + delta) % 24
+
+def display_timeline(event_log):
     st.subheader("📜 Recent Changes Timeline")
-    for event in reversed(st.session_state.event_log):
+    for event in reversed(event_log):
         timestamp, key, bpm = event
         st.markdown(f"- **{timestamp}** | 🎵 Key: `{key}` | 🕑 BPM: `{bpm}`")
 
+def display_telemetry(telemetry):
+    st.subheader("⏱️ Loop Telemetry")
+    records = telemetry.snapshot()
+    if not records:
+        st.caption("No loops played yet.")
+        return
+    st.dataframe(list(reversed(records[-20:])))
+    st.json(telemetry.summary(), expanded=False)
+
+@st.fragment(run_every=LIVE_REFRESH_SECONDS)
+def live_panel():
+    # Reruns on its own timer; only this panel is redrawn, not the page.
+    controller = st.session_state.playback_controller
+    state = controller.snapshot()
+    if state["errors"]:
+        st.warning(f"⚠️ Playback errors {state['errors']} | last: {state['last_error']}")
+    if state["now_playing"]:
+        st.subheader("🎵 Now Playing")
+        st.json(state["now_playing"])
+
+    timeline_col, telemetry_col = st.columns(2)
+    with timeline_col:
+        display_timeline(state["event_log"])
+    with telemetry_col:
+        display_telemetry(controller.telemetry)
+
 # ---- Streamlit UI ----
 st.title("🎵 Daily Wellness Music Generator")
 
@@ -159,15 +93,13 @@ if goal_selection and style_selection:
 
     col1, col2, col3 = st.columns(3)
     with col1:
-        if st.button("⏪ Back 1 Hour"):
-            st.session_state.simulated_hour = (st.session_state.simulated_hour - 1) % 24
+        st.button("⏪ Back 1 Hour", on_click=shift_hour, args=(-1,))
     with col2:
         st.write(f"### {st.session_state.simulated_hour:02d}:00h")
     with col3:
-        if st.button("⏩ Forward 1 Hour"):
-            st.session_state.simulated_hour = (st.session_state.simulated_hour + 1) % 24
+        st.button("⏩ Forward 1 Hour", on_click=shift_hour, args=(1,))
 
-    params = generate_music_parameters(goal_selection, style_selection, st.session_state.simulated_hour)
+    params = generate_loop_parameters(goal_selection, style_selection, st.session_state.simulated_hour)
 
     st.subheader("🎶 Generated Music Parameters for Simulated Time")
     st.json(params)
@@ -175,35 +107,30 @@ if goal_selection and style_selection:
     # ---- Continuous Playback Controls ----
     st.subheader("🎛️ Playback Controls")
 
-    def params_generator(goal, style, simulated_hour):
-        current_hour = simulated_hour
-        while True:
-            yield generate_music_parameters(goal, style, current_hour)
-            current_hour = (current_hour + 1) % 24
-
     if not st.session_state.playback_controller.is_playing:
         if st.button("▶️ Play Continuous"):
-            st.session_state.playback_controller.start(
-                params_generator(goal_selection, style_selection, st.session_state.simulated_hour)
-            )
+            try:
+                st.session_state.playback_controller.start(
+                    params_generator(goal_selection, style_selection, st.session_state.simulated_hour),
+                    soundfont=style_soundfont(style_selection),  # Only the presets this style plays
+                )
+                st.rerun()
+            except Exception as exc:
+                st.error(f"Could not start playback: {exc}")
     else:
         if st.button("⏹️ Stop"):
             st.session_state.playback_controller.stop()
-            st.experimental_rerun()
+            st.rerun()
 
     # ---- Current Loop Parameters and Timeline ----
-    if st.session_state.current_loop_params:
-        st.subheader("🎵 Now Playing")
-        st.json(st.session_state.current_loop_params)
-
-    update_ui_event_log()
-    display_timeline()
+    live_panel()
 
     # ---- Manual Generation for Testing ----
     if st.button("🎹 Generate Music (One Time)"):
-        generator = LoopGen(params)
+        generator = LoopGen(params, reporter=st.write)
         generator.generate()
+        generator.export()
 
     if st.button("🎵 Play Loop (One Time)"):
-        loop = LoopGen(params)
-        loop.generate()
\ No newline at end of file
+        loop = LoopGen(params, reporter=st.write)
+        loop.play_midi(loop.generate())
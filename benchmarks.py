@@ -0,0 +1,206 @@
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import theory
+from loopgen import LoopGen, generate_batch
+from music_params import CATALOG_VARIANTS, GOALS, STYLES, derive_seed, generate_music_parameters, select_biased_key
+from synth_engine import SOUNDFONT_PATH
+
+PHRASE_LENGTHS = [4, 8, 16]
+BENCH_SEED = 1234
+
+
+def measure(fn, repeat, warmup=1):
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    mean = sum(samples) / len(samples)
+    return {
+        "repeat": repeat,
+        "mean_ms": round(mean * 1000, 4),
+        "p50_ms": round(samples[len(samples) // 2] * 1000, 4),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000, 4),
+        "ops_per_s": round(1 / mean, 1) if mean else None,
+    }
+
+
+def seeded_params(goal, style, hour=9, variant=0, phrase_length=None):
+    params = generate_music_parameters(goal, style, hour, derive_seed(goal, style, hour, BENCH_SEED + variant))
+    if phrase_length is not None:
+        params["phrase_length"] = phrase_length
+    return params
+
+
+def fluidsynth_available():
+    try:
+        import fluidsynth  # noqa: F401
+    except (ImportError, OSError) as exc:
+        return f"fluidsynth unavailable: {exc}"
+    if not os.path.exists(SOUNDFONT_PATH) or os.path.getsize(SOUNDFONT_PATH) < 1024:
+        return f"soundfont missing or not fetched from LFS: {SOUNDFONT_PATH}"
+    return None
+
+
+# ---- Benchmarks ----
+def bench_generate(repeat):
+    for goal in GOALS:
+        for style in STYLES[:2]:
+            for phrase_length in PHRASE_LENGTHS:
+                params = seeded_params(goal, style, phrase_length=phrase_length)
+                result = measure(lambda: LoopGen(params).generate(), repeat)
+                events = LoopGen(params).generate()
+                yield dict(bench="generate", goal=goal, style=style, phrase_length=phrase_length,
+                           events=len(events), audio_s=round(events.length, 2), **result)
+
+    # A day's catalog for one goal and style, looped versus batched
+    catalog = [seeded_params(goal, style, hour, variant) for goal in GOALS[:1] for style in STYLES[:1]
+               for hour in range(24) for variant in range(CATALOG_VARIANTS)]
+    for case, fn in (("loop", lambda: [LoopGen(params).generate() for params in catalog]),
+                     ("batch", lambda: generate_batch(catalog))):
+        yield dict(bench="generate_catalog", case=case, loops=len(catalog), **measure(fn, repeat))
+
+
+def bench_theory(repeat):
+    progression = seeded_params("Focus", "Jazz")["chord_progression"]
+    cases = {
+        "scale_notes": lambda: theory.scale_notes("Bb", "Dorian"),
+        "chord_notes": lambda: theory.chord_notes("Bb", "Dorian", 4),
+        "common_tone_indices": lambda: theory.common_tone_indices("Dorian", "C", "G"),
+        "compile_progression": lambda: theory.compile_progression(progression),
+        "select_biased_key": lambda: select_biased_key("Reflective", "Evening"),
+    }
+    for name, fn in cases.items():
+        result = measure(lambda: [fn() for _ in range(1000)], repeat)
+        yield dict(bench="theory", case=name, calls_per_op=1000, **result)
+
+
+def bench_serialize(repeat):
+    events = LoopGen(seeded_params("Focus", "Jazz", phrase_length=16)).generate()
+    cases = {
+        "smf_bytes": events.to_smf_bytes,
+        "packed_bytes": events.to_bytes,
+        "mido_objects": events.to_midi,
+    }
+    for name, fn in cases.items():
+        result = measure(fn, repeat)
+        yield dict(bench="serialize", case=name, events=len(events), **result)
+
+
+def bench_render(repeat):
+    skipped = fluidsynth_available()
+    if skipped:
+        yield dict(bench="render", skipped=skipped)
+        return
+    from renderer import render_midi
+    from synth_engine import SynthEngine
+
+    engine = SynthEngine(driver=None)
+    try:
+        for phrase_length in PHRASE_LENGTHS:
+            events = LoopGen(seeded_params("Relax", "Ambient", phrase_length=phrase_length)).generate()
+            factors = [render_midi(events, engine=engine).realtime_factor for _ in range(repeat)]
+            yield dict(bench="render", phrase_length=phrase_length, audio_s=round(events.length, 2),
+                       realtime_factor=round(statistics.mean(factors), 5),
+                       speedup=round(1 / statistics.mean(factors), 1))
+    finally:
+        engine.shutdown()
+
+
+def bench_mix(repeat):
+    import numpy as np
+    from mixer import LoopMixer
+    from renderer import DEFAULT_SAMPLE_RATE, TAIL_SECONDS
+
+    # Synthetic PCM of real loop lengths: the mixer's cost does not depend on the audio.
+    rng = np.random.default_rng(BENCH_SEED)
+    for phrase_length in PHRASE_LENGTHS:
+        loops = [LoopGen(seeded_params("Relax", "Ambient", variant=v, phrase_length=phrase_length)).generate()
+                 for v in range(2)]
+        pcms = [rng.integers(-8000, 8000, size=(int((loop.length + TAIL_SECONDS) * DEFAULT_SAMPLE_RATE), 2),
+                             dtype=np.int16) for loop in loops]
+        mixer = LoopMixer()
+        mixer.add(pcms[0], loops[0].bpm)
+        result = measure(lambda: mixer.add(pcms[1], loops[1].bpm), repeat)
+        audio_s = loops[1].length
+        yield dict(bench="mix", phrase_length=phrase_length, audio_s=round(audio_s, 2),
+                   realtime_factor=round(result["mean_ms"] / 1000 / audio_s, 6), **result)
+
+
+def bench_playback(loops):
+    skipped = fluidsynth_available()
+    if skipped:
+        yield dict(bench="playback", skipped=skipped)
+        return
+    from playback_controller import PlaybackController
+
+    # Short loops so the boundaries come quickly; the engine runs without an
+    # audio device on the sequencer's system timer.
+    def short_loops():
+        for variant in range(loops):
+            params = seeded_params("Energy", "Electronic/EDM", variant=variant, phrase_length=4)
+            params.update(chord_progression="I-V", bpm=240)
+            yield params
+
+    controller = PlaybackController(driver=None)
+    started = time.perf_counter()
+    controller.start(short_loops())
+    try:
+        engine = controller.engine.engine  # The shared synth behind this session's channel bank
+        controller.thread.join()
+        elapsed = time.perf_counter() - started
+        stats = engine.timing_stats()
+    finally:
+        controller.stop()
+
+    gaps = list(controller.loop_gaps_ms)
+    yield dict(bench="playback", loops=loops, elapsed_s=round(elapsed, 3),
+               gap_max_ms=round(max(gaps), 3) if gaps else None,
+               gap_mean_ms=round(statistics.mean(gaps), 3) if gaps else None,
+               jitter_mean_ms=round(stats.get("mean_ms", 0.0), 3),
+               jitter_max_ms=round(stats.get("max_ms", 0.0), 3))
+
+
+BENCHMARKS = {
+    "generate": bench_generate,
+    "theory": bench_theory,
+    "serialize": bench_serialize,
+    "render": bench_render,
+    "mix": bench_mix,
+    "playback": bench_playback,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless performance benchmarks (JSON lines on stdout)")
+    parser.add_argument("--only", choices=list(BENCHMARKS), action="append", help="run just these benchmarks")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--playback-loops", type=int, default=4)
+    parser.add_argument("--output", metavar="FILE", help="also append results to FILE")
+    args = parser.parse_args(argv)
+
+    output = open(args.output, "a") if args.output else None
+    try:
+        for name in args.only or list(BENCHMARKS):
+            arg = args.playback_loops if name == "playback" else args.repeat
+            for result in BENCHMARKS[name](arg):
+                result.update(python=sys.version.split()[0], seed=BENCH_SEED)
+                line = json.dumps(result)
+                print(line, flush=True)
+                if output:
+                    output.write(line + "\n")
+    finally:
+        if output:
+            output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+import argparse
+import json
+import logging
+import os
+import time
+
+from loop_cache import LoopCache, generate_cached, render_cached
+from synth_engine import SOUNDFONT_PATH, SynthEngine
+from music_params import GOALS, STYLES, derive_seed, generate_music_parameters
+
+
+def cmd_generate(args):
+    for directory in (args.export, args.render):
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    cache = LoopCache(directory=args.cache) if args.cache else None
+    hour = args.hour
+    engine = None
+    if args.render:
+        from renderer import DEFAULT_SAMPLE_RATE
+
+        # One synth for every loop, so the soundfont is loaded once.
+        engine = SynthEngine(driver=None, sample_rate=DEFAULT_SAMPLE_RATE)
+    try:
+        for index in range(args.count):
+            started = time.perf_counter()
+            seed = derive_seed(args.goal, args.style, hour, args.seed + index) if args.seed is not None else None
+            params = generate_music_parameters(args.goal, args.style, hour, seed)
+            selected = time.perf_counter()
+            events = generate_cached(params, cache)
+            generated = time.perf_counter()
+
+            record = {
+                "loop": index,
+                "hour": hour,
+                "seed": params["seed"],
+                "key": params["key"],
+                "bpm": params["bpm"],
+                "duration_s": round(events.length, 3),
+                "params_ms": round((selected - started) * 1000, 3),
+                "generate_ms": round((generated - selected) * 1000, 3),
+            }
+            if args.export:
+                record["midi"] = events.save(os.path.join(args.export, f"loop_{index:04d}.mid"))
+            if args.render:
+                result = render_cached(params, cache, engine=engine, events=events)
+                record["wav"] = result.save_wav(os.path.join(args.render, f"loop_{index:04d}.wav"))
+                record["render_rtf"] = round(result.realtime_factor, 4)
+            print(json.dumps(record), flush=True)
+
+            if args.advance_hour:
+                hour = (hour + 1) % 24
+    finally:
+        if engine is not None:
+            engine.shutdown()
+
+def cmd_plan_day(args):
+    from day_planner import render_day
+
+    manifest = render_day(args.goal, args.style, args.output, args.hour, args.seed, args.loops_per_hour, args.workers)
+    summary = {key: value for key, value in manifest.items() if key != "segments"}
+    summary["segments"] = len(manifest["segments"])
+    print(json.dumps(summary))
+
+
+def cmd_soundfonts(args):
+    from sf2_subset import style_programs, subset_path
+
+    for style in args.style or STYLES:
+        started = time.perf_counter()
+        path = subset_path(style_programs(style), args.source)
+        print(json.dumps({"style": style, "path": path, "bytes": os.path.getsize(path),
+                          "seconds": round(time.perf_counter() - started, 3)}), flush=True)
+
+
+def cmd_serve(args):
+    import asyncio
+    from stream_server import StreamServer
+
+    async def serve():
+        server = StreamServer(args.host, args.port, args.workers, day_dir=args.day, cache_dir=args.cache)
+        await server.start()
+        try:
+            await server.server.serve_forever()
+        finally:
+            await server.close()
+
+    asyncio.run(serve())
+
+
+def cmd_loadtest(args):
+    import asyncio
+    from stream_server import load_test
+
+    print(json.dumps(asyncio.run(load_test(args.clients, args.seconds, args.workers, args.goal, args.style))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Headless MoodRingMusic loop generation")
+    parser.add_argument("-v", "--verbose", action="store_true", help="log loop parameters")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    generate = commands.add_parser("generate", help="generate N loops without a UI or audio device")
+    generate.add_argument("--goal", choices=GOALS, default="Focus")
+    generate.add_argument("--style", choices=STYLES, default="Ambient")
+    generate.add_argument("--hour", type=int, default=7, help="simulated hour of day (0-23)")
+    generate.add_argument("-n", "--count", type=int, default=1)
+    generate.add_argument("--advance-hour", action="store_true", help="move the simulated hour forward per loop")
+    generate.add_argument("--seed", type=int, help="base seed; makes the run reproducible")
+    generate.add_argument("--cache", metavar="DIR", help="reuse and store loops in an on-disk cache")
+    generate.add_argument("--export", metavar="DIR", help="write each loop as a .mid file")
+    generate.add_argument("--render", metavar="DIR", help="render each loop offline to a .wav file")
+    generate.set_defaults(func=cmd_generate)
+
+    plan_day = commands.add_parser("plan-day", help="pre-render a full 24-hour schedule in parallel")
+    plan_day.add_argument("output", metavar="DIR", help="directory for segments and manifest.json")
+    plan_day.add_argument("--goal", choices=GOALS, default="Focus")
+    plan_day.add_argument("--style", choices=STYLES, default="Ambient")
+    plan_day.add_argument("--hour", type=int, default=0, help="simulated hour the day starts at (0-23)")
+    plan_day.add_argument("--seed", type=int, default=0)
+    plan_day.add_argument("--loops-per-hour", type=int, help="fixed loop count per hour (default: fill each hour)")
+    plan_day.add_argument("--workers", type=int, help="render processes (default: one per core)")
+    plan_day.set_defaults(func=cmd_plan_day)
+
+    soundfonts = commands.add_parser("soundfonts", help="build the per-style soundfont subsets ahead of time")
+    soundfonts.add_argument("--style", choices=STYLES, action="append", help="only these styles (default: all)")
+    soundfonts.add_argument("--source", default=SOUNDFONT_PATH, help="full soundfont to subset")
+    soundfonts.set_defaults(func=cmd_soundfonts)
+
+    serve = commands.add_parser("serve", help="stream rendered audio to many listeners over HTTP")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    serve.add_argument("--workers", type=int, help="render processes (default: one per core)")
+    serve.add_argument("--day", metavar="DIR", help="also stream a plan-day output from its WAVs on /day")
+    serve.add_argument("--cache", metavar="DIR", help="also keep seeded section renders in an on-disk cache")
+    serve.set_defaults(func=cmd_serve)
+
+    loadtest = commands.add_parser("loadtest", help="run the stream server against local clients and report capacity")
+    loadtest.add_argument("--clients", type=int, default=4)
+    loadtest.add_argument("--seconds", type=float, default=30.0, help="audio seconds to read per client")
+    loadtest.add_argument("--workers", type=int)
+    loadtest.add_argument("--goal", choices=GOALS, default="Focus")
+    loadtest.add_argument("--style", choices=STYLES, default="Ambient")
+    loadtest.set_defaults(func=cmd_loadtest)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format="%(message)s")
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
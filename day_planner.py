@@ -0,0 +1,116 @@
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from loopgen import LoopGen
+from midi_events import LoopEvents
+from music_params import derive_seed, generate_music_parameters
+from renderer import DEFAULT_SAMPLE_RATE, init_worker, render_events
+
+MANIFEST_NAME = "manifest.json"
+HOUR_SECONDS = 3600
+
+
+def plan_day(goal, style, start_hour=0, seed=0, loops_per_hour=None):
+    # Walk the simulated day hour by hour. With loops_per_hour=None each hour is
+    # filled with loops until its hour of wall-clock time is covered. Lengths
+    # come from the params alone; the loops are generated once, by the workers.
+    segments = []
+    offset = 0.0
+    for step in range(24):
+        hour = (start_hour + step) % 24
+        hour_end = (step + 1) * HOUR_SECONDS
+        variant = 0
+        while (variant < loops_per_hour) if loops_per_hour else (offset < hour_end):
+            params = generate_music_parameters(goal, style, hour, derive_seed(goal, style, hour, seed * 1000 + variant))
+            segments.append({
+                "index": len(segments),
+                "hour": hour,
+                "phase": params["circadian_phase"],
+                "key": params["key"],
+                "bpm": params["bpm"],
+                "seed": params["seed"],
+                "params": params,
+            })
+            offset += LoopGen(params).length_seconds()
+            variant += 1
+    return segments
+
+
+def render_segment(params, wav_path, events_path, sample_rate):
+    events = LoopGen(params).generate()
+    with open(events_path, "wb") as f:
+        f.write(events.to_bytes())
+    result, cpu_seconds = render_events(events, sample_rate)
+    result.save_wav(wav_path)
+    return events.length, result.render_seconds, cpu_seconds
+
+
+def render_day(goal, style, output_dir, start_hour=0, seed=0, loops_per_hour=None, workers=None,
+               sample_rate=DEFAULT_SAMPLE_RATE):
+    os.makedirs(output_dir, exist_ok=True)
+    started = time.perf_counter()
+    segments = plan_day(goal, style, start_hour, seed, loops_per_hour)
+    planned = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(sample_rate,)) as pool:
+        futures = []
+        for segment in segments:
+            name = f"segment_{segment['index']:05d}"
+            segment["wav"] = name + ".wav"
+            segment["events"] = name + ".events"
+            futures.append(pool.submit(render_segment, segment["params"], os.path.join(output_dir, segment["wav"]),
+                                       os.path.join(output_dir, segment["events"]), sample_rate))
+        offset = 0.0
+        for segment, future in zip(segments, futures):
+            duration, render_seconds, cpu_seconds = future.result()
+            segment["start_s"] = round(offset, 3)
+            segment["duration_s"] = round(duration, 3)
+            segment["render_s"] = round(render_seconds, 3)
+            segment["render_cpu_s"] = round(cpu_seconds, 3)
+            offset += duration
+
+    rendered = time.perf_counter()
+    manifest = {
+        "goal": goal,
+        "style": style,
+        "start_hour": start_hour,
+        "seed": seed,
+        "sample_rate": sample_rate,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "total_duration_s": round(sum(s["duration_s"] for s in segments), 3),
+        "plan_s": round(planned - started, 3),
+        "render_wall_s": round(rendered - planned, 3),
+        "render_cpu_s": round(sum(s["render_cpu_s"] for s in segments), 3),
+        "segments": segments,
+    }
+    with open(os.path.join(output_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def load_manifest(output_dir):
+    with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def day_segments(output_dir, start_index=0):
+    # Segments in schedule order, wrapping at the end of the day.
+    segments = load_manifest(output_dir)["segments"]
+    index = start_index
+    while segments:
+        yield segments[index % len(segments)]
+        index += 1
+
+
+def manifest_params(output_dir, start_index=0):
+    # Params for PlaybackController; "events_file" makes the controller read
+    # the loop from disk. The WAVs are streamed by stream_server's /day.
+    for segment in day_segments(output_dir, start_index):
+        yield dict(segment["params"], events_file=os.path.join(output_dir, segment["events"]))
+
+
+def load_segment_events(path):
+    with open(path, "rb") as f:
+        return LoopEvents.from_bytes(f.read())
@@ -0,0 +1,184 @@
+import hashlib
+import io
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from loopgen import GENERATOR_VERSION, LoopGen, generate_batch
+from midi_events import LoopEvents
+from synth_engine import SOUNDFONT_PATH
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "moodringmusic")
+
+
+def soundfont_identity(path):
+    # Path plus size and mtime, so replacing the soundfont invalidates renders.
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return os.path.abspath(path)
+    return f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def cache_key(params, seed=None, soundfont=None, render_settings=None, kind="events"):
+    if seed is None:
+        seed = params.get("seed")
+    payload = {
+        "kind": kind,
+        "generator": GENERATOR_VERSION,
+        "params": params,
+        "seed": seed,
+        "soundfont": soundfont_identity(soundfont) if soundfont else None,
+        "render": render_settings or {},
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str).encode()
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def events_cache_key(events, soundfont=None, render_settings=None):
+    # For renders of events that depend on more than one loop's params, such
+    # as streamed sections, which pivot into the next loop's key.
+    digest = hashlib.sha256(events.to_bytes()).hexdigest()
+    return cache_key({"events": digest}, soundfont=soundfont, render_settings=render_settings, kind="pcm")
+
+
+class LoopCache:
+    """Content-addressed byte cache: an in-memory LRU in front of an optional
+    on-disk LRU, both bounded."""
+
+    def __init__(self, max_items=64, directory=None, max_memory_bytes=256 * 1024 * 1024,
+                 max_disk_bytes=2 * 1024 * 1024 * 1024):
+        self.max_items = max_items
+        self.directory = directory
+        self.max_memory_bytes = max_memory_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.memory = OrderedDict()
+        self.memory_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.directory, key + ".bin")
+
+    def get(self, key):
+        with self.lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return data
+
+        data = None
+        if self.directory:
+            path = self.path_for(key)
+            try:
+                with open(path, "rb") as f:
+                    data = f.read()
+                os.utime(path)  # Disk LRU is ordered by mtime
+            except OSError:
+                data = None
+
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.remember(key, data)
+        return data
+
+    def put(self, key, data):
+        with self.lock:
+            self.remember(key, data)
+        if self.directory:
+            path = self.path_for(key)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            self.evict_disk()
+
+    def remember(self, key, data):
+        # Caller holds self.lock
+        previous = self.memory.pop(key, None)
+        if previous is not None:
+            self.memory_bytes -= len(previous)
+        self.memory[key] = data
+        self.memory_bytes += len(data)
+        while len(self.memory) > 1 and (len(self.memory) > self.max_items
+                                        or self.memory_bytes > self.max_memory_bytes):
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def evict_disk(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".bin"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+                total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    def get_or_create(self, key, factory):
+        data = self.get(key)
+        if data is None:
+            data = factory()
+            self.put(key, data)
+        return data
+
+    def stats(self):
+        with self.lock:
+            return {"items": len(self.memory), "bytes": self.memory_bytes, "hits": self.hits, "misses": self.misses}
+
+
+# ---- Cached Generation and Rendering ----
+def generate_cached(params, cache=None):
+    if cache is None or params.get("seed") is None:
+        return LoopGen(params).generate()
+    data = cache.get_or_create(cache_key(params), lambda: LoopGen(params).generate().to_bytes())
+    return LoopEvents.from_bytes(data)
+
+
+def generate_catalog(params_list, cache):
+    # Pre-generates the seeded loops the cache is missing in one batch; returns how many.
+    keys = {cache_key(params): params for params in params_list if params.get("seed") is not None}
+    missing = [key for key in keys if cache.get(key) is None]
+    if missing:
+        for key, events in zip(missing, generate_batch([keys[key] for key in missing])):
+            cache.put(key, events.to_bytes())
+    return len(missing)
+
+
+def render_cached(params, cache=None, sample_rate=None, soundfont=SOUNDFONT_PATH, engine=None, events=None):
+    # events: the loop for params if the caller already has it, so it is not generated again.
+    import renderer
+
+    sample_rate = sample_rate or renderer.DEFAULT_SAMPLE_RATE
+    settings = {"sample_rate": sample_rate, "tail_seconds": renderer.TAIL_SECONDS}
+
+    def render():
+        loop = events if events is not None else generate_cached(params, cache)
+        return renderer.render_midi(loop, sample_rate=sample_rate, engine=engine, soundfont=soundfont)
+
+    if cache is None or params.get("seed") is None:
+        return render()
+
+    key = cache_key(params, soundfont=soundfont, render_settings=settings, kind="pcm")
+    data = cache.get(key)
+    if data is not None:
+        pcm, rate = renderer.read_wav(io.BytesIO(data))
+        return renderer.RenderResult(pcm, rate, len(pcm) / rate, 0.0)
+    result = render()
+    cache.put(key, result.to_wav_bytes())
+    return result
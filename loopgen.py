@@ -1,18 +1,58 @@
-import mido
-import streamlit as st
+import logging
 import time
-import fluidsynth
 import random
+import uuid
+import numpy as np
+from midi_events import PROGRAM_CHANGE, LoopEvents, as_loop_events, make_events, note_events
+from synth_engine import acquire_shared_bank
+import theory
 
-NOTE_TO_MIDI = {
-    'C': 0, 'C#': 1, 'Db': 1, 'D': 2, 'D#': 3, 'Eb': 3, 'E': 4,
-    'F': 5, 'F#': 6, 'Gb': 6, 'G': 7, 'G#': 8, 'Ab': 8, 'A': 9,
-    'A#': 10, 'Bb': 10, 'B': 11
-}
+TICKS_PER_BEAT = 480
+MELODY_MOVES = [-2, -1, 1, 2, -3, 3]
+MELODY_WEIGHTS = [10, 30, 30, 10, 10, 10]
+MELODY_PROBABILITIES = np.array(MELODY_WEIGHTS) / sum(MELODY_WEIGHTS)
+GENERATOR_VERSION = 2  # Bump when equal (params, seed) start producing different loops
+
+logger = logging.getLogger(__name__)
+
+def loop_programs(instruments):
+    # GM programs for the chord, melody and bass channels.
+    chord_instr = instruments[0] if instruments else 0
+    melody_instr = instruments[1] if len(instruments) > 1 else (chord_instr + 1) % 128
+    bass_instr = instruments[2] if len(instruments) > 2 else 33
+    return [chord_instr, melody_instr, bass_instr]
+
+def walk_scale_indices(starts, moves, tops, pivots):
+    """Clipped random walks over scale indices, one per row, all at once.
+
+    Each step adds its move and clips to [0, top], except where pivots is not
+    -1: there the walk jumps to that index. The walk is a cumulative sum that
+    is corrected from the first clipped or pivot step of each row onward, so
+    the loop runs once per boundary hit or pivot run rather than once per step.
+    """
+    forced = pivots >= 0
+    # Within a pivot run each step is the move from one pivot to the next.
+    steps = np.where(forced, np.diff(pivots, axis=1, prepend=-1), moves)
+    path = starts[:, None] + np.cumsum(steps, axis=1)
+    tops = tops[:, None]
+    columns = np.arange(path.shape[1])
+    while True:
+        target = np.where(forced, pivots, np.clip(path, 0, tops))
+        wrong = target != path
+        rows = np.flatnonzero(wrong.any(axis=1))
+        if not len(rows):
+            return path
+        first = wrong[rows].argmax(axis=1)
+        shift = target[rows, first] - path[rows, first]
+        path[rows] += np.where(columns >= first[:, None], shift[:, None], 0)
 
 class LoopGen:
-    def __init__(self, params: dict):
+    def __init__(self, params: dict, reporter=None, seed=None):
         self.params = params
+        self.report = reporter or logger.info
+        self.seed = params.get("seed") if seed is None else seed
+        self.rng = random.Random(self.seed)  # Per-generator, so equal (params, seed) give equal loops
+        self.np_rng = np.random.default_rng(self.seed)  # Melody walks
         self.simulated_hour = params.get("simulated_hour", 0)
         self.circadian_phase = params.get("circadian_phase", "Unknown")
         self.bpm = params.get("bpm", 120)
@@ -21,137 +61,213 @@ class LoopGen:
         self.key = params.get("key", "C")
         self.instruments = params.get("instruments", [])
         self.phrase_length = params.get("phrase_length", 8)
+        self.events = None
+        self.melody_index = None  # Scale index the melody last stopped on
         self.print_parameters()
 
     def print_parameters(self):
-        st.write("🎵 **LoopGen Parameters Loaded:**")
+        self.report("🎵 **LoopGen Parameters Loaded:**")
         for k, v in self.params.items():
-            st.write(f"• {k.replace('_', ' ').title()}: {v}")
-
-    def play_midi(self, file_path):
-        fs = fluidsynth.Synth()
-        fs.start(driver="coreaudio")
-        sfid = fs.sfload("soundfonts/FluidR3_GM.sf2")
-        fs.program_select(0, sfid, 0, 0)
-
-        mid = mido.MidiFile(file_path)
-        for msg in mid.play():
-            if msg.type == 'note_on':
-                fs.noteon(0, msg.note, msg.velocity)
-            elif msg.type == 'note_off':
-                fs.noteoff(0, msg.note)
-            elif msg.type == 'program_change':
-                fs.program_change(0, msg.program)
-            time.sleep(msg.time)
-
-        fs.delete()
-
-    def generate_melody_sequence(self, scale_notes, length, rhythm, upcoming_key=None):
-        sequence = []
-        current_note = random.choice(scale_notes)
-        pivot_zone = length // 4
-
-        if upcoming_key:
-            next_scale_notes = self.get_scale_notes(upcoming_key, self.scale)
-            common_notes = list(set(scale_notes) & set(next_scale_notes))
-        else:
-            common_notes = []
+            self.report(f"• {k.replace('_', ' ').title()}: {v}")
 
-        for i in range(length):
-            if upcoming_key and i >= (length - pivot_zone) and common_notes:
-                current_note = random.choice(common_notes)
-            else:
-                move = random.choices([-2, -1, 1, 2, -3, 3], weights=[10, 30, 30, 10, 10, 10])[0]
-                next_index = scale_notes.index(current_note) + move
-                next_index = max(0, min(next_index, len(scale_notes) - 1))
-                current_note = scale_notes[next_index]
+    def play_midi(self, midi, bank=None):
+        # On the caller's bank, or on one of its own so a running session is not cut off.
+        if bank is not None:
+            bank.wait_until(bank.schedule(as_loop_events(midi)))
+            return
+        from sf2_subset import programs_soundfont  # sf2_subset imports this module
 
-            sequence.append(current_note)
-        return sequence
+        bank = acquire_shared_bank(soundfont=programs_soundfont(loop_programs(self.instruments)))
+        try:
+            bank.wait_until(bank.schedule(as_loop_events(midi)))
+        finally:
+            bank.release()
 
-    def generate(self):
-        ticks_per_beat = 480
-        mid = mido.MidiFile(ticks_per_beat=ticks_per_beat)
-        chord_track = mido.MidiTrack()
-        melody_track = mido.MidiTrack()
-        bass_track = mido.MidiTrack()
-        mid.tracks.extend([chord_track, melody_track, bass_track])
-
-        chord_instr = self.instruments[0] if self.instruments else 0
-        melody_instr = self.instruments[1] if len(self.instruments) > 1 else (chord_instr + 1) % 128
-        bass_instr = self.instruments[2] if len(self.instruments) > 2 else 33
-
-        chord_track.append(mido.Message('program_change', program=chord_instr, channel=0, time=0))
-        melody_track.append(mido.Message('program_change', program=melody_instr, channel=1, time=0))
-        bass_track.append(mido.Message('program_change', program=bass_instr, channel=2, time=0))
-
-        scale_notes = self.get_scale_notes(self.key, self.scale)
+    def plan_keys(self, next_key=None):
+        # (degree, key, upcoming key) per progression section. next_key makes the
+        # last section pivot into the following loop's key.
         current_key = self.key
-        progression_sections = self.chord_progression.split('-')
-
-        for section in progression_sections:
+        progression = theory.compile_progression(self.chord_progression)
+        last = len(progression.degrees) - 1
+        keys = []
+        for i, (degree, bridge) in enumerate(zip(progression.degrees, progression.bridges)):
             upcoming_key = current_key
-            if "bridge" in section and random.random() < 0.5:
+            if bridge and self.rng.random() < 0.5:
                 # Key Change!
-                possible_keys = [k for k in NOTE_TO_MIDI if k != current_key]
+                possible_keys = theory.OTHER_KEYS.get(current_key, theory.KEY_NAMES)
                 if possible_keys:
-                    upcoming_key = random.choice(possible_keys)
-
-            # Chords
-            chord = self.get_chord_notes(scale_notes, section.strip())
-            for note in chord:
-                chord_track.append(mido.Message('note_on', note=note, velocity=50, time=0, channel=0))
-            for note in chord:
-                chord_track.append(mido.Message('note_off', note=note, velocity=50, time=ticks_per_beat, channel=0))
-
-            # Melody
-            melody_rhythm = [ticks_per_beat // 2, ticks_per_beat // 4, ticks_per_beat // 4]
-            melody_len = self.phrase_length * 2
-            melody_seq = self.generate_melody_sequence(scale_notes, melody_len, melody_rhythm, upcoming_key)
-
-            for note in melody_seq:
-                for duration in melody_rhythm:
-                    melody_track.append(mido.Message('note_on', note=note, velocity=100, time=0, channel=1))
-                    melody_track.append(mido.Message('note_off', note=note, velocity=100, time=duration, channel=1))
-
-            # Bass Pivot
-            pivot_zone = self.phrase_length // 4
-            for i in range(self.phrase_length):
-                bass_note = chord[0] - 12 if i < (self.phrase_length - pivot_zone) else chord[0]
-                bass_note = max(36, bass_note)
-                bass_track.append(mido.Message('note_on', note=bass_note, velocity=80, time=0, channel=2))
-                bass_track.append(mido.Message('note_off', note=bass_note, velocity=80, time=ticks_per_beat, channel=2))
-
+                    upcoming_key = self.rng.choice(possible_keys)
+            if next_key and i == last:
+                upcoming_key = next_key
+            keys.append((degree, current_key, upcoming_key))
             current_key = upcoming_key
-            scale_notes = self.get_scale_notes(current_key, self.scale)
+        return keys
+
+    def pivot_table(self, key_pairs):
+        # Common-tone scale indices per (key, upcoming key), padded into one array.
+        common = [theory.common_tone_indices(self.scale, key, upcoming) for key, upcoming in key_pairs]
+        table = np.zeros((len(common), max(map(len, common), default=0) or 1), dtype=np.int64)
+        for row, indices in enumerate(common):
+            table[row, :len(indices)] = indices
+        return table, np.array([len(indices) for indices in common])
+
+    def draw_pivots(self, common, rows, length):
+        # The last quarter of every row jumps between common tones; -1 elsewhere.
+        table, counts = common
+        pivot_zone = length // 4
+        pivots = np.full((rows, length), -1)
+        if pivot_zone:
+            picks = (self.np_rng.random((rows, pivot_zone)) * counts[:, None]).astype(np.int64)
+            zone = np.take_along_axis(table, picks, axis=1)
+            pivots[:, length - pivot_zone:] = np.where(counts[:, None] > 0, zone, -1)
+        return pivots
+
+    def melody_rows(self, keys, continuous=False, start_index=None):
+        # Inputs to walk_scale_indices for the loop's melody: one row per section,
+        # or a single row through every section when continuous.
+        length = self.phrase_length * 2
+        top = len(self.get_scale_notes(self.key, self.scale)) - 1
+        moves = self.np_rng.choice(MELODY_MOVES, size=(len(keys), length), p=MELODY_PROBABILITIES)
+        pivots = self.draw_pivots(self.pivot_table([key_pair for _, *key_pair in keys]), len(keys), length)
+        if continuous:
+            start = self.np_rng.integers(top + 1) if start_index is None else min(start_index, top)
+            return np.array([start]), moves.reshape(1, -1), np.array([top]), pivots.reshape(1, -1)
+        return self.np_rng.integers(top + 1, size=len(keys)), moves, np.full(len(keys), top), pivots
+
+    def sections(self, keys, indices):
+        # Yields (chord, melody notes) per section from walked scale indices.
+        indices = indices.reshape(len(keys), -1)
+        self.melody_index = int(indices[-1, -1])
+        for (degree, current_key, _), section in zip(keys, indices):
+            yield (theory.chord_notes(current_key, self.scale, degree),
+                   np.asarray(self.get_scale_notes(current_key, self.scale))[section])
+
+    def plan_sections(self, next_key=None, continuous=False):
+        # Yields (chord, melody notes) per progression section. next_key makes the
+        # last section pivot into the following loop's key; continuous carries the
+        # melody's scale index from section to section instead of restarting it.
+        keys = self.plan_keys(next_key)
+        rows = self.melody_rows(keys, continuous, self.melody_index if continuous else None)
+        return self.sections(keys, walk_scale_indices(*rows))
+
+    def program_events(self):
+        return make_events([0, 0, 0], [0, 1, 2], PROGRAM_CHANGE, loop_programs(self.instruments), 0)
 
-        output_file = "loopgen_output.mid"
-        mid.save(output_file)
-        st.success(f"🎶 MIDI file generated with melody and bass: `{output_file}`")
+    def track_events(self, chords, melody_notes):
+        # Each track runs on its own cursor from tick 0, as separate MIDI tracks do.
+        ticks_per_beat = TICKS_PER_BEAT
+        chords = np.array(chords, dtype=np.int64)
+        melody_rhythm = [ticks_per_beat // 2, ticks_per_beat // 4, ticks_per_beat // 4]
 
-        self.play_midi(output_file)
-        return mid.length  # Return duration for the playback controller
+        # Chords: struck together, then released one note per beat
+        release = np.arange(1, chords.shape[1] + 1) * ticks_per_beat
+        chord_ticks = np.repeat(np.arange(len(chords)) * release[-1], chords.shape[1])
+        chord_events = note_events(chord_ticks, np.tile(release, len(chords)), 0, chords.ravel(), 50)
+
+        # Melody: every note is struck once per rhythm step
+        durations = np.tile(melody_rhythm, len(melody_notes))
+        melody_ticks = np.cumsum(durations) - durations
+        melody_events = note_events(melody_ticks, durations, 1, np.repeat(melody_notes, len(melody_rhythm)), 100)
+
+        # Bass Pivot: an octave below the root, rising to the root for the last quarter
+        pivot_zone = self.phrase_length // 4
+        low = np.arange(self.phrase_length) < (self.phrase_length - pivot_zone)
+        bass_notes = np.maximum(36, chords[:, :1] - 12 * low[None, :]).ravel()
+        bass_ticks = np.arange(len(bass_notes)) * ticks_per_beat
+        bass_events = note_events(bass_ticks, ticks_per_beat, 2, bass_notes, 80)
+
+        return np.concatenate([chord_events, melody_events, bass_events])
+
+    def length_seconds(self):
+        # generate()'s .length without generating: tracks restart together every
+        # section, so the longest track's section length decides.
+        sections = len(theory.compile_progression(self.chord_progression).degrees)
+        chord_ticks = len(theory.chord_notes(self.key, self.scale, 0)) * TICKS_PER_BEAT
+        section_ticks = max(chord_ticks, self.phrase_length * 2 * TICKS_PER_BEAT, self.phrase_length * TICKS_PER_BEAT)
+        return sections * section_ticks * (int(round(60e6 / self.bpm)) / 1e6 / TICKS_PER_BEAT)
+
+    def generate(self):
+        return self.assemble(self.plan_sections())
+
+    def assemble(self, sections):
+        chords = []
+        melody_notes = []
+        for chord, melody in sections:
+            chords.append(chord)
+            melody_notes.append(melody)
+        melody_notes = np.concatenate(melody_notes)
+
+        events = np.concatenate([self.program_events(), self.track_events(chords, melody_notes)])
+        self.events = LoopEvents(events, TICKS_PER_BEAT, tempo=int(round(60e6 / self.bpm)))
+        return self.events  # In memory; .length is the duration for the playback controller
+
+    def stream(self, next_key=None, melody_index=None, standalone=False):
+        # One LoopEvents per progression section, built only when asked for. All
+        # three tracks of a section start together, so the sections play back to
+        # back; the first also carries the program changes, or every one with
+        # standalone, so each can be rendered on whichever synth is free.
+        tempo = int(round(60e6 / self.bpm))
+        self.melody_index = melody_index
+        programs = self.program_events()
+        for chord, melody in self.plan_sections(next_key, continuous=True):
+            events = self.track_events([chord], melody)
+            if programs is not None:
+                events = np.concatenate([programs, events])
+                if not standalone:
+                    programs = None
+            yield LoopEvents(events, TICKS_PER_BEAT, tempo=tempo)
+
+    def export(self, output_file=None):
+        if self.events is None:
+            self.generate()
+        if output_file is None:
+            output_file = f"loopgen_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.mid"
+        self.events.save(output_file)
+        self.report(f"🎶 MIDI file exported with melody and bass: `{output_file}`")
+        return output_file
 
     def get_scale_notes(self, key, scale_name):
-        semitone_steps = {
-            "Major": [0, 2, 4, 5, 7, 9, 11],
-            "Minor": [0, 2, 3, 5, 7, 8, 10],
-            "Pentatonic": [0, 2, 4, 7, 9],
-            "Dorian": [0, 2, 3, 5, 7, 9, 10],
-            "Mixolydian": [0, 2, 4, 5, 7, 9, 10],
-            "Lydian": [0, 2, 4, 6, 7, 9, 11],
-            "Aeolian": [0, 2, 3, 5, 7, 8, 10],
-            "Phrygian": [0, 1, 3, 5, 7, 8, 10],
-            "Harmonic Minor": [0, 2, 3, 5, 7, 8, 11]
-        }
-        steps = semitone_steps.get(scale_name, semitone_steps["Major"])
-        key_base = NOTE_TO_MIDI.get(key.replace(" Minor", "").replace(" Major", ""), 0) + 60
-        return [key_base + step for step in steps]
-
-    def get_chord_notes(self, scale_notes, numeral):
-        numeral_map = {"I": 0, "ii": 1, "iii": 2, "IV": 3, "V": 4, "vi": 5, "vii": 6}
-        degree = numeral_map.get(numeral, 0)
-        root = scale_notes[degree % len(scale_notes)]
-        third = scale_notes[(degree + 2) % len(scale_notes)]
-        fifth = scale_notes[(degree + 4) % len(scale_notes)]
-        return [root, third, fifth]
\ No newline at end of file
+        return theory.scale_notes(key, scale_name)
+
+
+def generate_batch(params_list, reporter=None):
+    # Many loops with one walk over all their melodies; each loop is the same
+    # as LoopGen(params).generate() would give, as every generator keeps its own RNG.
+    gens = [LoopGen(params, reporter=reporter) for params in params_list]
+    keys = [gen.plan_keys() for gen in gens]
+    rows = [gen.melody_rows(loop_keys) for gen, loop_keys in zip(gens, keys)]
+    width = max(row[1].shape[1] for row in rows)
+    starts = np.concatenate([row[0] for row in rows])
+    tops = np.concatenate([row[2] for row in rows])
+    moves = np.zeros((len(starts), width), dtype=np.int64)  # Shorter rows are padded with
+    pivots = np.full((len(starts), width), -1)  # steps that neither move nor pivot
+    offset = 0
+    for _, row_moves, _, row_pivots in rows:
+        count, length = row_moves.shape
+        moves[offset:offset + count, :length] = row_moves
+        pivots[offset:offset + count, :length] = row_pivots
+        offset += count
+    paths = walk_scale_indices(starts, moves, tops, pivots)
+
+    loops = []
+    offset = 0
+    for gen, loop_keys, row in zip(gens, keys, rows):
+        count, length = row[1].shape
+        loops.append(gen.assemble(gen.sections(loop_keys, paths[offset:offset + count, :length])))
+        offset += count
+    return loops
+
+
+def stream_session(params_iter, reporter=None, standalone=False):
+    # Endless generation one progression section at a time, so memory stays flat
+    # however long a session runs. Each loop's last section pivots into the next
+    # loop's key and the melody picks up where the previous loop left it.
+    params = next(params_iter, None)
+    melody_index = None
+    while params is not None:
+        following = next(params_iter, None)
+        gen = LoopGen(params, reporter=reporter)
+        for events in gen.stream(following.get("key") if following else None, melody_index, standalone):
+            yield params, events
+        melody_index = gen.melody_index
+        params = following
@@ -0,0 +1,182 @@
+import io
+import struct
+import numpy as np
+
+EVENT_DTYPE = np.dtype([
+    ("tick", "<u4"),
+    ("channel", "u1"),
+    ("type", "u1"),
+    ("note", "u1"),      # Program number for PROGRAM_CHANGE
+    ("velocity", "u1"),
+])
+
+# Type codes double as the sort order for events that share a tick, so a
+# note is released before it is struck again on the same tick.
+PROGRAM_CHANGE = 0
+NOTE_OFF = 1
+NOTE_ON = 2
+
+STATUS_BYTES = np.array([0xC0, 0x80, 0x90], dtype=np.uint8)
+DEFAULT_TEMPO = 500000  # Microseconds per beat (120 BPM), as in the MIDI spec
+PACKED_HEADER = struct.Struct("<4sHII")  # magic, ticks_per_beat, tempo, length_ticks
+PACKED_MAGIC = b"LEV1"
+
+
+def make_events(ticks, channel, event_type, notes, velocity):
+    events = np.empty(len(ticks), dtype=EVENT_DTYPE)
+    events["tick"] = ticks
+    events["channel"] = channel
+    events["type"] = event_type
+    events["note"] = notes
+    events["velocity"] = velocity
+    return events
+
+
+def note_events(on_ticks, durations, channel, notes, velocity):
+    on_ticks = np.asarray(on_ticks)
+    return np.concatenate([
+        make_events(on_ticks, channel, NOTE_ON, notes, velocity),
+        make_events(on_ticks + durations, channel, NOTE_OFF, notes, velocity),
+    ])
+
+
+def encode_vlq(values):
+    # Vectorised MIDI variable-length quantities: returns a (n, 4) byte matrix
+    # and a mask of the bytes that are actually emitted.
+    values = np.asarray(values, dtype=np.uint32)
+    groups = np.stack([(values >> shift) & 0x7F for shift in (21, 14, 7, 0)], axis=1).astype(np.uint8)
+    sizes = 1 + (values >= 1 << 7) + (values >= 1 << 14) + (values >= 1 << 21)
+    mask = np.arange(4)[None, :] >= (4 - sizes)[:, None]
+    groups[:, :3] |= 0x80
+    return groups, mask
+
+
+class LoopEvents:
+    """A loop as one sorted struct array of (tick, channel, type, note, velocity)."""
+
+    def __init__(self, events, ticks_per_beat=480, tempo=DEFAULT_TEMPO, length_ticks=None):
+        order = np.lexsort((events["type"], events["tick"]))
+        self.events = events[order]
+        self.ticks_per_beat = ticks_per_beat
+        self.tempo = tempo
+        if length_ticks is None:
+            length_ticks = int(self.events["tick"][-1]) if len(self.events) else 0
+        self.length_ticks = length_ticks
+
+    def __len__(self):
+        return len(self.events)
+
+    @property
+    def seconds_per_tick(self):
+        return self.tempo / 1e6 / self.ticks_per_beat
+
+    @property
+    def length(self):
+        return self.length_ticks * self.seconds_per_tick
+
+    @property
+    def bpm(self):
+        return 60e6 / self.tempo
+
+    def seconds(self):
+        return self.events["tick"] * self.seconds_per_tick
+
+    def channels(self):
+        return np.unique(self.events["channel"]).tolist()
+
+    def select_channels(self, channels):
+        # Same loop (and length) with only the given channels' events.
+        keep = np.isin(self.events["channel"], channels)
+        return LoopEvents(self.events[keep], self.ticks_per_beat, self.tempo, self.length_ticks)
+
+    def iter_timed(self):
+        # (seconds, channel, type, note, velocity) tuples, for feeding a synth.
+        events = self.events
+        return zip(self.seconds().tolist(), events["channel"].tolist(), events["type"].tolist(),
+                   events["note"].tolist(), events["velocity"].tolist())
+
+    # ---- Standard MIDI File ----
+    def track_bytes(self, events, tempo_event=False):
+        deltas = np.diff(events["tick"].astype(np.int64), prepend=0)
+        vlq, vlq_mask = encode_vlq(deltas)
+
+        is_program = events["type"] == PROGRAM_CHANGE
+        body = np.empty((len(events), 3), dtype=np.uint8)
+        body[:, 0] = STATUS_BYTES[events["type"]] | events["channel"]
+        body[:, 1] = events["note"]
+        body[:, 2] = events["velocity"]
+        body_mask = np.ones((len(events), 3), dtype=bool)
+        body_mask[:, 2] = ~is_program
+
+        data = np.concatenate([vlq, body], axis=1)[np.concatenate([vlq_mask, body_mask], axis=1)]
+
+        out = bytearray()
+        if tempo_event:
+            out += b"\x00\xff\x51\x03" + int(self.tempo).to_bytes(3, "big")
+        out += data.tobytes()
+        last_tick = int(events["tick"][-1]) if len(events) else 0
+        end_vlq, end_mask = encode_vlq([max(0, self.length_ticks - last_tick)])
+        out += end_vlq[end_mask].tobytes() + b"\xff\x2f\x00"
+        return b"MTrk" + len(out).to_bytes(4, "big") + bytes(out)
+
+    def to_smf_bytes(self):
+        # Format 1, one track per channel, tempo in the first track.
+        channels = self.channels() or [0]
+        tracks = [self.track_bytes(self.events[self.events["channel"] == channel], tempo_event=(i == 0))
+                  for i, channel in enumerate(channels)]
+        header = b"MThd" + (6).to_bytes(4, "big") + (1).to_bytes(2, "big") \
+            + len(tracks).to_bytes(2, "big") + self.ticks_per_beat.to_bytes(2, "big")
+        return header + b"".join(tracks)
+
+    # ---- Packed form, for caches ----
+    def to_bytes(self):
+        header = PACKED_HEADER.pack(PACKED_MAGIC, self.ticks_per_beat, int(self.tempo), self.length_ticks)
+        return header + self.events.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, ticks_per_beat, tempo, length_ticks = PACKED_HEADER.unpack_from(data)
+        if magic != PACKED_MAGIC:
+            raise ValueError("Not a packed LoopEvents buffer")
+        events = np.frombuffer(data, dtype=EVENT_DTYPE, offset=PACKED_HEADER.size).copy()
+        return cls(events, ticks_per_beat, tempo, length_ticks)
+
+    def save(self, path):
+        with open(path, "wb") as f:
+            f.write(self.to_smf_bytes())
+        return path
+
+    def to_midi(self):
+        import mido
+
+        return mido.MidiFile(file=io.BytesIO(self.to_smf_bytes()))
+
+    @classmethod
+    def from_midi(cls, mid):
+        import mido
+
+        rows = []
+        tempo = DEFAULT_TEMPO
+        tick = 0
+        for msg in mido.merge_tracks(mid.tracks):
+            tick += msg.time
+            if msg.type == 'set_tempo' and tick == 0:
+                tempo = msg.tempo
+            elif msg.type == 'note_on' and msg.velocity > 0:
+                rows.append((tick, msg.channel, NOTE_ON, msg.note, msg.velocity))
+            elif msg.type in ('note_on', 'note_off'):
+                rows.append((tick, msg.channel, NOTE_OFF, msg.note, msg.velocity))
+            elif msg.type == 'program_change':
+                rows.append((tick, msg.channel, PROGRAM_CHANGE, msg.program, 0))
+        return cls(np.array(rows, dtype=EVENT_DTYPE), mid.ticks_per_beat, tempo, length_ticks=tick)
+
+
+def as_loop_events(midi):
+    # Accept LoopEvents, a mido.MidiFile or a path to a .mid file.
+    if isinstance(midi, LoopEvents):
+        return midi
+    if isinstance(midi, (str, bytes)) or hasattr(midi, "__fspath__"):
+        import mido
+
+        midi = mido.MidiFile(midi)
+    return LoopEvents.from_midi(midi)
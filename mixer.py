@@ -0,0 +1,78 @@
+from functools import lru_cache
+
+import numpy as np
+from renderer import DEFAULT_SAMPLE_RATE, TAIL_SECONDS
+
+BEATS_PER_BAR = 4
+FADE_BARS = 1
+MAX_FADE_SECONDS = 4.0
+
+
+@lru_cache(maxsize=32)
+def equal_power_curves(frames):
+    # cos/sin gains keep the summed power constant across the overlap.
+    t = (np.arange(frames, dtype=np.float32) + 0.5) / frames * np.float32(np.pi / 2)
+    return np.cos(t)[:, None], np.sin(t)[:, None]
+
+
+def bar_frames(bpm, sample_rate=DEFAULT_SAMPLE_RATE, beats_per_bar=BEATS_PER_BAR):
+    return int(round(60.0 / bpm * beats_per_bar * sample_rate))
+
+
+def crossfade(outgoing, incoming):
+    # Equal-power mix of two int16 blocks of the same shape.
+    fade_out, fade_in = equal_power_curves(len(outgoing))
+    mixed = outgoing.astype(np.float32) * fade_out + incoming.astype(np.float32) * fade_in
+    return np.clip(np.rint(mixed), -32768, 32767).astype(np.int16)
+
+
+def overlay(ringing, incoming):
+    # Sum of two int16 blocks of the same shape, clipped.
+    mixed = ringing.astype(np.int32) + incoming
+    return np.clip(mixed, -32768, 32767).astype(np.int16)
+
+
+class LoopMixer:
+    """Joins rendered loops into one continuous stream. The last bar and ringing
+    tail of each loop are held back and crossfaded under the head of the next
+    loop, which starts on that bar line so the downbeats of both tempos meet.
+    A loop may also arrive section by section; a section's tail rings on under
+    the next section of the same loop instead."""
+
+    def __init__(self, sample_rate=DEFAULT_SAMPLE_RATE, fade_bars=FADE_BARS, beats_per_bar=BEATS_PER_BAR,
+                 max_fade_seconds=MAX_FADE_SECONDS, tail_seconds=TAIL_SECONDS):
+        self.sample_rate = sample_rate
+        self.fade_bars = fade_bars
+        self.beats_per_bar = beats_per_bar
+        self.max_fade_frames = int(max_fade_seconds * sample_rate)
+        self.tail_frames = int(round(tail_seconds * sample_rate))
+        self.held = None  # int16 frames of the previous loop still to be mixed
+        self.ringing = False  # held is a section's tail rather than a loop's fade
+
+    def add(self, pcm, bpm, ends_loop=True):
+        # Returns the int16 frames that are final and can be played now.
+        pcm = np.array(pcm, dtype=np.int16).reshape(-1, 2)
+        overlap = 0
+        if self.held is not None and len(self.held):
+            overlap = len(self.held)
+            if len(pcm) < overlap:
+                pcm = np.concatenate([pcm, np.zeros((overlap - len(pcm), 2), dtype=np.int16)])
+            pcm[:overlap] = (overlay if self.ringing else crossfade)(self.held, pcm[:overlap])
+
+        body_end = max(overlap, len(pcm) - self.tail_frames)
+        self.ringing = not ends_loop
+        if not ends_loop:
+            self.held = pcm[body_end:]
+            return pcm[:body_end]
+
+        # The outgoing fade covers whole bars ending at the loop's musical end.
+        fade = bar_frames(bpm, self.sample_rate, self.beats_per_bar) * self.fade_bars
+        while fade > self.max_fade_frames and fade > 1:
+            fade //= 2  # Fall back to half and quarter bars at very slow tempos
+        fade_start = max(overlap, body_end - fade)
+        self.held = pcm[fade_start:]
+        return pcm[:fade_start]
+
+    def flush(self):
+        held, self.held = self.held, None
+        return held if held is not None else np.zeros((0, 2), dtype=np.int16)
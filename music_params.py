@@ -0,0 +1,140 @@
+import hashlib
+import random
+
+# ---- Constants ----
+GOALS = ["Focus", "Relax", "Energy", "Sleep", "Creative Flow", "Calm Confidence", "Romantic", "Reflective"]
+STYLES = ["Ambient", "Jazz", "Classical", "Electronic/EDM", "Pop", "World", "Folk/Acoustic", "Cinematic/Orchestral"]
+
+BPM_RANGES = {
+    "Focus": {"Morning": (90, 110), "Midday": (100, 120), "Evening": (80, 100), "Night": (60, 80)},
+    "Relax": {"Morning": (70, 90), "Midday": (80, 100), "Evening": (60, 80), "Night": (40, 60)},
+    "Energy": {"Morning": (100, 120), "Midday": (120, 140), "Evening": (110, 130), "Night": (90, 110)},
+    "Sleep": {"Evening": (50, 70), "Night": (40, 60)},
+    "Creative Flow": {"Morning": (90, 110), "Midday": (100, 120), "Evening": (80, 100)},
+    "Calm Confidence": {"Morning": (80, 100), "Midday": (90, 110), "Evening": (70, 90)},
+    "Romantic": {"Evening": (60, 80), "Night": (50, 70)},
+    "Reflective": {"Evening": (60, 80), "Night": (50, 70)}
+}
+
+CHORD_PROGRESSIONS = {
+    "Focus": ["I-vi-IV-V", "ii-V-I", "Modal Dorian"],
+    "Relax": ["I-IV-I", "I-vi-IV-I", "Lydian Static"],
+    "Energy": ["I-V-vi-IV", "IV-V-I", "Dominant Cycle"],
+    "Sleep": ["I-ii-I", "Pedal Tones", "Open 5ths"],
+    "Creative Flow": ["I-V-vi-IV", "ii-V-I", "Modal Mixolydian"],
+    "Calm Confidence": ["I-IV-V-I", "ii-V-I", "I-vi-ii-V"],
+    "Romantic": ["I-vi-IV-V", "ii-V-I", "I-IV-I"],
+    "Reflective": ["I-vi-IV-I", "Modal Aeolian", "I-ii-IV-V"]
+}
+
+INSTRUMENT_SETS = {
+    "Ambient": [88, 90, 91, 94, 95, 81, 82],
+    "Jazz": [0, 1, 26, 27, 56, 57, 32, 33],
+    "Classical": [0, 48, 49, 50, 46],
+    "Electronic/EDM": [81, 82, 83, 88, 89, 90, 97, 98],
+    "Pop": [0, 1, 25, 26, 80, 81],
+    "World": [104, 105, 106, 73, 74, 115, 116],
+    "Folk/Acoustic": [24, 25, 26, 105, 22],
+    "Cinematic/Orchestral": [48, 49, 60, 61, 117, 118]
+}
+
+SCALE_MAP = {
+    "Focus": ["Dorian", "Mixolydian", "Major"],
+    "Relax": ["Lydian", "Major", "Pentatonic"],
+    "Energy": ["Major", "Mixolydian", "Phrygian"],
+    "Sleep": ["Aeolian", "Dorian", "Pentatonic"],
+    "Creative Flow": ["Lydian", "Mixolydian", "Dorian"],
+    "Calm Confidence": ["Major", "Dorian"],
+    "Romantic": ["Harmonic Minor", "Aeolian", "Major"],
+    "Reflective": ["Aeolian", "Dorian", "Pentatonic"]
+}
+
+KEY_MAP = {
+    "Focus": ["C", "A", "F"],
+    "Relax": ["F", "Eb", "Bb"],
+    "Energy": ["G", "D", "E"],
+    "Sleep": ["A Minor", "C Minor", "G Minor"],
+    "Creative Flow": ["E", "G", "D"],
+    "Calm Confidence": ["C", "F", "Bb"],
+    "Romantic": ["Bb", "D Minor", "A Minor"],
+    "Reflective": ["C Minor", "D Minor", "Eb", "G Minor"]
+}
+
+CIRCADIAN_KEY_BIAS = {
+    "Morning": ["C", "G", "F", "A"],
+    "Midday": ["D", "E", "G", "A"],
+    "Early Afternoon": ["E", "G", "A", "D"],
+    "Late Afternoon": ["F", "Bb", "Eb"],
+    "Evening": ["Bb", "Eb", "C Minor", "D Minor"],
+    "Night": ["A Minor", "C Minor", "G Minor", "D Minor"],
+    "Sleep": ["A Minor", "C Minor", "G Minor"]
+}
+
+# ---- Circadian Functions ----
+def get_circadian_phase(hour):
+    if 6 <= hour < 9:
+        return "Morning"
+    elif 9 <= hour < 12:
+        return "Midday"
+    elif 12 <= hour < 15:
+        return "Early Afternoon"
+    elif 15 <= hour < 18:
+        return "Late Afternoon"
+    elif 18 <= hour < 21:
+        return "Evening"
+    elif 21 <= hour < 24:
+        return "Night"
+    else:
+        return "Sleep"
+
+def key_candidates(goal, phase):
+    goal_keys = KEY_MAP.get(goal, ["C"])
+    phase_keys = CIRCADIAN_KEY_BIAS.get(phase, ["C"])
+    common_keys = tuple(key for key in goal_keys if key in phase_keys)
+    if common_keys:
+        return common_keys
+    return tuple(goal_keys + phase_keys * 2)
+
+# ---- Per-(goal, phase) Candidates, indexed once at import ----
+PHASES = list(CIRCADIAN_KEY_BIAS)
+KEY_CANDIDATES = {(goal, phase): key_candidates(goal, phase) for goal in GOALS for phase in PHASES}
+BPM_CANDIDATES = {(goal, phase): BPM_RANGES.get(goal, {}).get(phase, (80, 100)) for goal in GOALS for phase in PHASES}
+
+CATALOG_VARIANTS = 8  # Distinct seeded loops per (goal, style, hour) in a continuous session
+
+def select_biased_key(goal, phase, rng=random):
+    candidates = KEY_CANDIDATES.get((goal, phase)) or key_candidates(goal, phase)
+    return rng.choice(candidates)
+
+def derive_seed(goal, style, hour, variant=0):
+    # Stable across processes (unlike hash()), so popular combinations hit the loop cache.
+    digest = hashlib.sha256(f"{goal}|{style}|{hour}|{variant}".encode()).digest()
+    return int.from_bytes(digest[:4], "big")
+
+def generate_music_parameters(goal, style, hour, seed=None):
+    if seed is None:
+        seed = random.getrandbits(32)
+    rng = random.Random(seed)
+    phase = get_circadian_phase(hour)
+    bpm_range = BPM_CANDIDATES.get((goal, phase)) or BPM_RANGES.get(goal, {}).get(phase, (80, 100))
+    bpm = rng.randint(*bpm_range)
+    phrase_length = rng.choices([4, 8, 16], weights=[1, 3, 5])[0]
+    chosen_progression = " - ".join(rng.choices(CHORD_PROGRESSIONS.get(goal, ["I-IV-V-I"]), k=phrase_length))
+    full_instrument_set = INSTRUMENT_SETS.get(style, [0])
+    chosen_instruments = rng.sample(full_instrument_set, min(len(full_instrument_set), rng.choice([3, 4])))
+    chosen_scale = rng.choice(SCALE_MAP.get(goal, ["Major"]))
+    chosen_key = select_biased_key(goal, phase, rng)
+
+    params = {
+        "simulated_hour": hour,
+        "circadian_phase": phase,
+        "bpm": bpm,
+        "chord_progression": chosen_progression,
+        "scale": chosen_scale,
+        "key": chosen_key,
+        "instruments": chosen_instruments,
+        "phrase_length": phrase_length,
+        "seed": seed
+    }
+
+    return params
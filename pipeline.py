@@ -0,0 +1,100 @@
+import logging
+import queue
+import threading
+
+MAX_CONSECUTIVE_ERRORS = 5
+
+logger = logging.getLogger(__name__)
+
+
+class Pipeline:
+    """Stages on long-lived threads joined by bounded queues.
+
+    The source iterator runs on its own thread and each stage function on one
+    more, so the thread count is fixed for the life of the pipeline and items
+    keep their order. A full queue blocks the stage feeding it, so nothing runs
+    more than `maxsize` items ahead of its consumer. An item whose stage raises
+    is dropped and reported to on_error; after max_errors failures in a row, or
+    if the source itself fails, the pipeline ends.
+    """
+
+    def __init__(self, source, stages=(), maxsize=1, check_interval=0.1, on_error=None,
+                 max_errors=MAX_CONSECUTIVE_ERRORS):
+        self.source = source
+        self.stages = list(stages)  # (name, fn) pairs
+        self.queues = [queue.Queue(maxsize=max(1, maxsize)) for _ in range(len(self.stages) + 1)]
+        self.check_interval = check_interval
+        self.on_error = on_error
+        self.max_errors = max_errors
+        self.consecutive_errors = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.threads = []
+
+    def start(self):
+        self.threads = [threading.Thread(target=self.run_source, name="pipeline-source", daemon=True)]
+        for index, (name, fn) in enumerate(self.stages):
+            self.threads.append(threading.Thread(target=self.run_stage, args=(index, name, fn),
+                                                 name=f"pipeline-{name}", daemon=True))
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def get(self, timeout=None):
+        # Next finished item, None once the pipeline has ended; raises queue.Empty on timeout.
+        return self.queues[-1].get(timeout=timeout if timeout is not None else self.check_interval)
+
+    def put(self, outbox, item):
+        while not self.stop_event.is_set():
+            try:
+                outbox.put(item, timeout=self.check_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def record_error(self, stage, exc):
+        logger.error("%s stage failed: %s", stage, exc, exc_info=exc)
+        if self.on_error:
+            self.on_error(stage, exc)
+        with self.lock:
+            self.consecutive_errors += 1
+            return self.consecutive_errors >= self.max_errors
+
+    def run_source(self):
+        try:
+            for item in self.source:
+                if not self.put(self.queues[0], item):
+                    return
+        except Exception as exc:
+            self.record_error("source", exc)
+        self.put(self.queues[0], None)
+
+    def run_stage(self, index, name, fn):
+        inbox, outbox = self.queues[index], self.queues[index + 1]
+        while not self.stop_event.is_set():
+            try:
+                item = inbox.get(timeout=self.check_interval)
+            except queue.Empty:
+                continue
+            if item is None:
+                self.put(outbox, None)
+                return
+            try:
+                result = fn(item)
+            except Exception as exc:
+                if self.record_error(name, exc):
+                    self.put(outbox, None)
+                    self.stop_event.set()
+                    return
+                continue
+            with self.lock:
+                self.consecutive_errors = 0
+            if not self.put(outbox, result):
+                return
@@ -1,19 +1,65 @@
+import queue
 import threading
 import time
-from loopgen import LoopGen
+from collections import Counter, deque
+from day_planner import load_segment_events
+from loop_cache import generate_cached
+from loopgen import stream_session
+from pipeline import Pipeline
+from quality import QualityGovernor, thin_events
+from synth_engine import DEFAULT_DRIVER, SCHEDULE_LEAD_TICKS, SEQUENCER_TIME_SCALE, SOUNDFONT_PATH, acquire_shared_bank
+from telemetry import Telemetry, ms
+
+JITTER_BUDGET_MS = 20.0  # Timer lateness that counts as a fully used real-time budget
 
 class PlaybackController:
-    def __init__(self):
+    def __init__(self, lookahead=1, check_interval=0.1, cache=None, driver=DEFAULT_DRIVER, streaming=False,
+                 telemetry=None):
         self.is_playing = False
         self.stop_event = threading.Event()
         self.thread = None
-        self.event_log = []  # Local log instead of using st.session_state directly
+        self.engine = None
+        self.lookahead = max(1, lookahead)  # Loops prepared ahead of the one playing
+        self.check_interval = check_interval
+        self.cache = cache  # Optional LoopCache for seeded loops
+        self.driver = driver
+        self.streaming = streaming  # Queue one progression section at a time instead of whole loops
+        self.loop_gaps_ms = deque(maxlen=100)  # Silence before each loop boundary
+        self.pipeline = None
+        self.errors = Counter()  # stage -> failures, across sessions
+        self.last_error = None
+        self.event_log = deque(maxlen=20)  # Local log instead of using st.session_state directly
+        self.now_playing = None
+        self.state_lock = threading.Lock()  # Guards event_log and now_playing for snapshot()
+        self.telemetry = telemetry or Telemetry()
+        self.synth_setup_ms = None
+        self.started_at = None
+        self.quality = QualityGovernor(name="playback quality")  # Kept across sessions: it reflects this machine
 
-    def start(self, loopgen_params_generator):
+    def start(self, loopgen_params_generator, soundfont=SOUNDFONT_PATH):
+        # soundfont: e.g. a style subset from sf2_subset.style_soundfont, for a faster, smaller synth
         if not self.is_playing:
-            self.is_playing = True
             self.stop_event.clear()
-            self.thread = threading.Thread(target=self.play_continuous, args=(loopgen_params_generator,))
+            self.started_at = time.perf_counter()
+            try:
+                self.engine = acquire_shared_bank(self.driver, soundfont)  # This session's channels on the one synth
+            except Exception as exc:
+                self.record_error("synth", exc)
+                raise
+            self.engine.apply_quality(self.quality.settings)
+            self.synth_setup_ms = ms(time.perf_counter() - self.started_at)
+            self.is_playing = True
+
+            # params -> generate -> output (this controller's player thread)
+            if self.streaming:
+                self.pipeline = Pipeline(self.stream_loops(loopgen_params_generator), maxsize=self.lookahead,
+                                         check_interval=self.check_interval, on_error=self.record_error)
+            else:
+                self.pipeline = Pipeline(self.select_params(loopgen_params_generator),
+                                         [("generate", self.generate_loop)], maxsize=self.lookahead,
+                                         check_interval=self.check_interval, on_error=self.record_error)
+            self.pipeline.start()
+            self.thread = threading.Thread(target=self.play_continuous, args=(self.pipeline,))
             self.thread.start()
 
     def stop(self):
@@ -21,42 +67,138 @@ class PlaybackController:
         self.stop_event.set()
         if self.thread:
             self.thread.join()
+        if self.engine:
+            bank, self.engine = self.engine, None
+            bank.release()
 
     def log_event(self, key, bpm):
         timestamp = time.strftime("%H:%M:%S")
-        self.event_log.append((timestamp, key, bpm))
-        if len(self.event_log) > 20:
-            self.event_log.pop(0)
+        with self.state_lock:
+            self.event_log.append((timestamp, key, bpm))
 
-    def play_continuous(self, params_generator):
-        current_key = None
+    def record_error(self, stage, exc):
+        with self.state_lock:
+            self.errors[stage] += 1
+            self.last_error = f"{stage}: {exc!r}"
 
-        while not self.stop_event.is_set():
-            params = next(params_generator)
-            new_key = params.get("key", "Unknown")
-            bpm = params.get("bpm", "Unknown")
+    def snapshot(self):
+        # Consistent copy of what the UI shows, safe to take while playback runs.
+        with self.state_lock:
+            return {
+                "is_playing": self.is_playing,
+                "now_playing": dict(self.now_playing) if self.now_playing else None,
+                "event_log": list(self.event_log),
+                "loops_logged": self.telemetry.count,
+                "errors": dict(self.errors),
+                "last_error": self.last_error,
+                "quality": self.quality.settings["name"],
+            }
 
-            if current_key and new_key != current_key:
-                self.log_event(new_key, bpm)
-            else:
-                self.log_event(new_key, bpm)
+    # ---- Pipeline Stages ----
+    def select_params(self, params_generator):
+        while True:
+            started = time.perf_counter()
+            params = next(params_generator, None)
+            if params is None:
+                return
+            yield params, {"params_ms": ms(time.perf_counter() - started)}
+
+    def generate_loop(self, item):
+        params, timings = item
+        started = time.perf_counter()
+        if "events_file" in params:
+            events = load_segment_events(params["events_file"])  # Pre-rendered day schedule
+        else:
+            events = generate_cached(params, self.cache)
+        timings["generate_ms"] = ms(time.perf_counter() - started)
+        return params, events, timings
+
+    def stream_loops(self, params_generator):
+        # Parameter selection happens inside the session, so it is timed with generation.
+        started = time.perf_counter()
+        for params, events in stream_session(params_generator):
+            yield params, events, {"generate_ms": ms(time.perf_counter() - started)}
+            started = time.perf_counter()
 
-            current_key = new_key
+    # ---- Output Stage ----
+    def play_continuous(self, pipeline):
+        try:
+            self.play_pipeline(pipeline)
+        except Exception as exc:
+            self.record_error("output", exc)
+        finally:
+            self.stop_event.set()
+            pipeline.stop()
+            # Released here as well as in stop(), so a session that ends on its
+            # own does not keep its channels after start() takes new ones.
+            bank, self.engine = self.engine, None
+            try:
+                bank.release()
+            except Exception as exc:
+                self.record_error("output", exc)
+            with self.state_lock:
+                self.now_playing = None
+            self.is_playing = False
+
+    def play_pipeline(self, pipeline):
+        current_params = None
+        next_start = None
+        jitter_total = 0
+
+        while not self.stop_event.is_set():
+            try:
+                item = pipeline.get(self.check_interval)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            params, events, timings = item
 
-            loop = LoopGen(params)
-            duration = loop.generate()
+            if params is not current_params:  # Streamed sections share their loop's params
+                with self.state_lock:
+                    self.now_playing = params
+                self.log_event(params.get("key", "Unknown"), params.get("bpm", "Unknown"))
+            current_params = params
 
-            playback_thread = threading.Thread(target=loop.play_midi, args=("loopgen_output.mid",))
-            playback_thread.start()
+            now = self.engine.now()
+            first = next_start is None
+            gap_ms = 0.0
+            if first:
+                next_start = now + SCHEDULE_LEAD_TICKS
+            elif next_start < now:
+                # The loop was not ready in time: restart the timeline rather
+                # than dispatching its overdue opening events in one burst.
+                gap_ms = (now + SCHEDULE_LEAD_TICKS - next_start) * 1000.0 / SEQUENCER_TIME_SCALE
+                next_start = now + SCHEDULE_LEAD_TICKS
+            if not first:
+                self.loop_gaps_ms.append(gap_ms)
+            loop_start = next_start
+            events = thin_events(events, self.quality.level)
+            scheduling = time.perf_counter()
+            next_start = self.engine.schedule(events, loop_start)
+            schedule_ms = ms(time.perf_counter() - scheduling)
 
-            wait_time = max(0, duration - 0.5)
-            check_interval = 0.1
-            elapsed = 0
+            # Queue the following loop only once this one is sounding, so the
+            # sequencer never holds more than one loop (or section) beyond the current one.
+            if not self.engine.wait_until(loop_start, self.stop_event, self.check_interval):
+                break
 
-            while elapsed < wait_time and not self.stop_event.is_set():
-                time.sleep(check_interval)
-                elapsed += check_interval
+            jitter, jitter_total = self.engine.jitter_since(jitter_total)
+            record = dict(timings, key=params.get("key"), bpm=params.get("bpm"), events=len(events),
+                          duration_s=round(events.length, 3), schedule_ms=schedule_ms, gap_ms=round(gap_ms, 3),
+                          headroom_ms=round((loop_start - now) * 1000.0 / SEQUENCER_TIME_SCALE, 3),
+                          jitter_max_ms=round(max(jitter), 3) if jitter else 0.0,
+                          quality=self.quality.settings["name"])
+            if first:
+                record.update(synth_setup_ms=self.synth_setup_ms,
+                              start_latency_ms=ms(time.perf_counter() - self.started_at))
+            self.telemetry.record(**record)
 
-            playback_thread.join()
+            # A late loop means the budget was exceeded outright. The live synth
+            # keeps its sample rate; polyphony, effects and instruments step.
+            load = max(record["jitter_max_ms"] / JITTER_BUDGET_MS, 1.0 if gap_ms else 0.0)
+            if self.quality.observe(load) is not None:
+                self.engine.apply_quality(self.quality.settings)
 
-        self.is_playing = False
\ No newline at end of file
+        if next_start is not None and not self.stop_event.is_set():
+            self.engine.wait_until(next_start, self.stop_event, self.check_interval)
@@ -0,0 +1,73 @@
+import logging
+import threading
+from collections import deque
+
+# Ordered from best to cheapest; the governor moves one level at a time.
+QUALITY_LEVELS = [
+    {"name": "full", "sample_rate": 44100, "polyphony": 256, "reverb": True, "chorus": True, "max_instruments": 3},
+    {"name": "reduced", "sample_rate": 44100, "polyphony": 128, "reverb": True, "chorus": False, "max_instruments": 3},
+    {"name": "low", "sample_rate": 32000, "polyphony": 64, "reverb": False, "chorus": False, "max_instruments": 3},
+    {"name": "minimal", "sample_rate": 22050, "polyphony": 32, "reverb": False, "chorus": False, "max_instruments": 2},
+]
+INSTRUMENT_PRIORITY = (1, 2, 0)  # Channels kept first when instruments are dropped: melody, bass, chords
+STEP_DOWN_LOAD = 0.8  # Fraction of the real-time budget in use
+STEP_UP_LOAD = 0.4
+WINDOW = 4
+
+logger = logging.getLogger(__name__)
+
+
+def kept_channels(level):
+    return sorted(INSTRUMENT_PRIORITY[:QUALITY_LEVELS[level]["max_instruments"]])
+
+
+def thin_events(events, level):
+    # Drops the lowest-priority tracks the level cannot afford.
+    channels = kept_channels(level)
+    if len(channels) >= len(INSTRUMENT_PRIORITY):
+        return events
+    return events.select_channels(channels)
+
+
+class QualityGovernor:
+    """Steps quality down when the measured load nears the real-time budget
+    and back up once there is headroom again.
+
+    Load is a fraction of the budget: a render's real-time factor over the
+    share of real time it may use, or wake-up lateness over a jitter budget.
+    One slow sample steps down at once; stepping up waits for a full window
+    of low readings so the level does not flap.
+    """
+
+    def __init__(self, levels=QUALITY_LEVELS, step_down=STEP_DOWN_LOAD, step_up=STEP_UP_LOAD, window=WINDOW,
+                 name="quality"):
+        self.levels = levels
+        self.step_down = step_down
+        self.step_up = step_up
+        self.loads = deque(maxlen=window)
+        self.level = 0
+        self.name = name
+        self.changes = 0
+        self.lock = threading.Lock()
+
+    @property
+    def settings(self):
+        return self.levels[self.level]
+
+    def observe(self, load):
+        # Returns the new level if this reading changed it, else None.
+        with self.lock:
+            self.loads.append(load)
+            previous = self.level
+            if load > self.step_down and self.level < len(self.levels) - 1:
+                self.level += 1
+            elif (self.level > 0 and len(self.loads) == self.loads.maxlen
+                  and max(self.loads) < self.step_up):
+                self.level -= 1
+            if self.level == previous:
+                return None
+            self.loads.clear()
+            self.changes += 1
+        logger.info("%s: %s -> %s (load %.2f)", self.name, self.levels[previous]["name"],
+                    self.levels[self.level]["name"], load)
+        return self.level
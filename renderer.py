@@ -0,0 +1,154 @@
+import io
+import time
+import wave
+import numpy as np
+from midi_events import as_loop_events
+from quality import QUALITY_LEVELS, thin_events
+from synth_engine import SynthEngine, SOUNDFONT_PATH
+
+DEFAULT_SAMPLE_RATE = 44100
+TAIL_SECONDS = 1.0  # Let the last notes ring out past the final event
+
+
+class RenderResult:
+    def __init__(self, pcm, sample_rate, audio_seconds, render_seconds):
+        self.pcm = pcm  # int16, shape (frames, 2)
+        self.sample_rate = sample_rate
+        self.audio_seconds = audio_seconds
+        self.render_seconds = render_seconds
+
+    @property
+    def realtime_factor(self):
+        # Render time per second of audio; below 1.0 is faster than real time.
+        return self.render_seconds / self.audio_seconds if self.audio_seconds else 0.0
+
+    def save_wav(self, path):
+        write_wav(path, self.pcm, self.sample_rate)
+        return path
+
+    def to_wav_bytes(self):
+        buffer = io.BytesIO()
+        write_wav(buffer, self.pcm, self.sample_rate)
+        return buffer.getvalue()
+
+
+def write_wav(path, pcm, sample_rate=DEFAULT_SAMPLE_RATE):
+    # path may also be a writable binary file object
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(pcm.shape[1] if pcm.ndim > 1 else 1)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(np.ascontiguousarray(pcm, dtype=np.int16).tobytes())
+
+
+def read_wav(path):
+    with wave.open(path, "rb") as wav:
+        channels = wav.getnchannels()
+        sample_rate = wav.getframerate()
+        pcm = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16).reshape(-1, channels)
+    return pcm, sample_rate
+
+
+def render_midi(events, sample_rate=DEFAULT_SAMPLE_RATE, engine=None, soundfont=None,
+                tail_seconds=TAIL_SECONDS):
+    # soundfont=None renders with the engine's current bank (the full one for a new engine).
+    events = as_loop_events(events)
+    owns_engine = engine is None
+    if owns_engine:
+        engine = SynthEngine(driver=None, sample_rate=sample_rate, soundfont=soundfont or SOUNDFONT_PATH)
+    if soundfont and soundfont != engine.soundfont:
+        engine.set_soundfont(soundfont)
+    engine.load_soundfont(engine.soundfont)
+
+    started = time.perf_counter()
+    chunks = []
+    frames_written = 0
+    positions = np.rint(events.seconds() * sample_rate).astype(np.int64).tolist()
+    events_array = events.events
+    try:
+        for position, channel, event_type, note, velocity in zip(
+                positions, events_array["channel"].tolist(), events_array["type"].tolist(),
+                events_array["note"].tolist(), events_array["velocity"].tolist()):
+            if position > frames_written:
+                chunks.append(engine.get_samples(position - frames_written))
+                frames_written = position
+            engine.send_event(channel, event_type, note, velocity)
+
+        end = int(round(events.length * sample_rate))
+        if end > frames_written:
+            chunks.append(engine.get_samples(end - frames_written))
+            frames_written = end
+        engine.reset()
+        tail_frames = int(round(tail_seconds * sample_rate))
+        if tail_frames > 0:
+            chunks.append(engine.get_samples(tail_frames))
+            frames_written += tail_frames
+    finally:
+        if owns_engine:
+            engine.shutdown()
+        else:
+            engine.reset(hard=True)
+
+    pcm = np.concatenate(chunks).reshape(-1, 2) if chunks else np.zeros((0, 2), dtype=np.int16)
+    render_seconds = time.perf_counter() - started
+    return RenderResult(pcm, sample_rate, frames_written / sample_rate, render_seconds)
+
+
+def resample(pcm, from_rate, to_rate):
+    # Linear interpolation per channel; used to bring reduced-quality renders
+    # back to the stream's sample rate.
+    if from_rate == to_rate or not len(pcm):
+        return pcm
+    frames = int(round(len(pcm) * to_rate / from_rate))
+    positions = np.arange(frames) * (from_rate / to_rate)
+    source = np.arange(len(pcm))
+    channels = [np.interp(positions, source, pcm[:, c]) for c in range(pcm.shape[1])]
+    return np.rint(np.stack(channels, axis=1)).astype(np.int16)
+
+
+def render_loop(loop, **kwargs):
+    events = loop.events if loop.events is not None else loop.generate()
+    return render_midi(events, **kwargs)
+
+
+def render_to_wav(events, path, **kwargs):
+    result = render_midi(events, **kwargs)
+    result.save_wav(path)
+    return result
+
+
+# ---- Process Pool Workers ----
+_worker_engine = None  # This worker's driverless synth
+
+
+def worker_engine(sample_rate):
+    # Quality levels with another sample rate retune the same synth; only if
+    # the library cannot is it replaced, so one soundfont copy stays loaded.
+    global _worker_engine
+    engine = _worker_engine
+    if engine is not None and engine.sample_rate != sample_rate and not engine.set_sample_rate(sample_rate):
+        engine.shutdown()
+        engine = None
+    if engine is None:
+        engine = _worker_engine = SynthEngine(driver=None, sample_rate=sample_rate)
+    return engine
+
+
+def init_worker(sample_rate=DEFAULT_SAMPLE_RATE):
+    # One driverless synth per worker process, so the soundfont is loaded once
+    # per core rather than once per loop.
+    worker_engine(sample_rate)
+
+
+def render_events(events, sample_rate=DEFAULT_SAMPLE_RATE, level=0):
+    # Renders at the quality level's settings and returns PCM at sample_rate.
+    settings = QUALITY_LEVELS[level]
+    render_rate = min(sample_rate, settings["sample_rate"])
+    cpu_started = time.process_time()
+    engine = worker_engine(render_rate)
+    engine.apply_quality(settings)
+    result = render_midi(thin_events(events, level), sample_rate=render_rate, engine=engine)
+    if render_rate != sample_rate:
+        result = RenderResult(resample(result.pcm, render_rate, sample_rate), sample_rate, result.audio_seconds,
+                              result.render_seconds)
+    return result, time.process_time() - cpu_started
@@ -0,0 +1,160 @@
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+
+RING_MAGIC = b"SRG2"
+HEADER = struct.Struct("<4sIIIQQQQ")  # magic, slots, sample_rate, channels, data_bytes, next_seq, oldest_seq, cursor
+ENTRY = struct.Struct("<QQQIf16s16s")  # seq, offset, position, frames, bpm, key, phase
+DEFAULT_RING_BYTES = 256 * 1024 * 1024
+DEFAULT_SLOTS = 1024
+
+
+class SegmentRing:
+    """Fixed-size, memory-mapped ring of PCM segments with a small index.
+
+    One writer appends; any number of readers, in this process or another one
+    that opens the same file, get zero-copy views of the segments. Appending
+    overwrites the oldest segments, so the file never grows. A reader checks
+    valid(seq) after consuming a view to know it was not overwritten meanwhile.
+    Each segment records its position, the stream frame it starts at.
+    """
+
+    def __init__(self, path, data_bytes=DEFAULT_RING_BYTES, slots=DEFAULT_SLOTS, sample_rate=44100, channels=2,
+                 create=True):
+        self.path = path
+        if create:
+            size = HEADER.size + slots * ENTRY.size + data_bytes
+            with open(path, "wb") as f:
+                f.truncate(size)
+        self.file = open(path, "r+b" if create else "rb")
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_WRITE if create else mmap.ACCESS_READ)
+        if create:
+            HEADER.pack_into(self.mm, 0, RING_MAGIC, slots, sample_rate, channels, data_bytes, 0, 0, 0)
+        magic, self.slots, self.sample_rate, self.channels, self.data_bytes = HEADER.unpack_from(self.mm, 0)[:5]
+        if magic != RING_MAGIC:
+            raise ValueError(f"{path} is not a segment ring")
+        self.data_start = HEADER.size + self.slots * ENTRY.size
+        self.frame_bytes = self.channels * 2
+
+    @classmethod
+    def open(cls, path):
+        # Read-only view of a ring another process is writing.
+        return cls(path, create=False)
+
+    # ---- Header ----
+    def counters(self):
+        next_seq, oldest_seq, cursor = HEADER.unpack_from(self.mm, 0)[5:]
+        return next_seq, oldest_seq, cursor
+
+    def set_counters(self, next_seq, oldest_seq, cursor):
+        struct.pack_into("<QQQ", self.mm, HEADER.size - 24, next_seq, oldest_seq, cursor)
+
+    def latest(self):
+        # Most recent complete segment, where a late-joining reader starts.
+        next_seq, oldest_seq, _ = self.counters()
+        return next_seq - 1 if next_seq > oldest_seq else None
+
+    def at(self, position):
+        # Segment holding stream frame `position`: the newest one starting at or
+        # before it, else the oldest retained one.
+        next_seq, oldest_seq, _ = self.counters()
+        for seq in range(next_seq - 1, oldest_seq - 1, -1):
+            entry = self.entry(seq)
+            if entry is not None and entry["position"] <= position:
+                return seq
+        return oldest_seq if next_seq > oldest_seq else None
+
+    def oldest(self):
+        return self.counters()[1]
+
+    def valid(self, seq):
+        next_seq, oldest_seq, _ = self.counters()
+        return oldest_seq <= seq < next_seq
+
+    # ---- Index ----
+    def entry(self, seq):
+        position = HEADER.size + (seq % self.slots) * ENTRY.size
+        stored, offset, stream_position, frames, bpm, key, phase = ENTRY.unpack_from(self.mm, position)
+        if stored != seq:
+            return None
+        return {"seq": seq, "offset": offset, "position": stream_position, "frames": frames, "bpm": round(bpm, 3),
+                "key": key.rstrip(b"\0").decode(), "phase": phase.rstrip(b"\0").decode()}
+
+    def entries(self):
+        next_seq, oldest_seq, _ = self.counters()
+        return [entry for entry in map(self.entry, range(oldest_seq, next_seq)) if entry]
+
+    # ---- Writer ----
+    def append(self, pcm, key="", bpm=0.0, phase=""):
+        pcm = np.ascontiguousarray(pcm, dtype=np.int16)
+        nbytes = pcm.nbytes
+        if nbytes > self.data_bytes:
+            raise ValueError(f"segment of {nbytes} bytes does not fit a {self.data_bytes}-byte ring")
+        next_seq, oldest_seq, cursor = self.counters()
+        latest = self.entry(next_seq - 1) if next_seq > oldest_seq else None
+        position = latest["position"] + latest["frames"] if latest else 0
+        start = cursor if cursor + nbytes <= self.data_bytes else 0
+        consumed = (start - cursor) % self.data_bytes + nbytes  # Includes any skipped end of the buffer
+
+        # Segments lie in ring order starting at the cursor, so the ones about
+        # to be overwritten are always the oldest. Retire them before writing.
+        while oldest_seq < next_seq:
+            entry = self.entry(oldest_seq)
+            if (entry is not None and (entry["offset"] - cursor) % self.data_bytes >= consumed
+                    and next_seq - oldest_seq < self.slots):
+                break
+            oldest_seq += 1
+        self.set_counters(next_seq, oldest_seq, cursor)
+
+        self.mm[self.data_start + start:self.data_start + start + nbytes] = pcm.reshape(-1).view(np.uint8)
+        ENTRY.pack_into(self.mm, HEADER.size + (next_seq % self.slots) * ENTRY.size, next_seq, start, position,
+                        nbytes // self.frame_bytes, bpm, key.encode()[:16], phase.encode()[:16])
+        self.set_counters(next_seq + 1, oldest_seq, start + nbytes)
+        return next_seq
+
+    # ---- Readers ----
+    def view(self, seq):
+        # (entry, memoryview of the segment's bytes), or None if not available.
+        if not self.valid(seq):
+            return None
+        entry = self.entry(seq)
+        if entry is None:
+            return None
+        start = self.data_start + entry["offset"]
+        return entry, memoryview(self.mm)[start:start + entry["frames"] * self.frame_bytes]
+
+    def pcm(self, seq):
+        found = self.view(seq)
+        if found is None:
+            return None
+        entry, data = found
+        return entry, np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels)
+
+    def follow(self, start=None, stop_event=None, poll_interval=0.05):
+        # Yields (entry, view) in order from `start` (default: the latest segment),
+        # skipping ahead to the oldest retained segment if the reader fell behind.
+        if start is None:
+            latest = self.latest()
+            start = latest if latest is not None else self.counters()[0]
+        seq = start
+        while stop_event is None or not stop_event.is_set():
+            found = self.view(seq)
+            if found is None:
+                oldest = self.oldest()
+                if seq < oldest:
+                    seq = oldest
+                else:
+                    time.sleep(poll_interval)
+                continue
+            yield found
+            seq += 1
+
+    def close(self, remove=False):
+        # Views handed out by view() must be released first.
+        self.mm.close()
+        self.file.close()
+        if remove:
+            os.remove(self.path)
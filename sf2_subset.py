@@ -0,0 +1,220 @@
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+
+from loop_cache import DEFAULT_CACHE_DIR, soundfont_identity
+from loopgen import loop_programs
+from music_params import INSTRUMENT_SETS
+from synth_engine import SOUNDFONT_PATH
+
+SUBSET_DIR = os.path.join(DEFAULT_CACHE_DIR, "soundfonts")
+GEN_INSTRUMENT = 41
+GEN_SAMPLE_ID = 53
+SAMPLE_PADDING = 46  # Zero samples the SF2 spec requires after every sample
+LINKED_SAMPLE_TYPES = (2, 4, 8)  # right, left, linked
+
+# pdta sub-chunk record layouts
+PHDR = struct.Struct("<20sHHHIII")
+BAG = struct.Struct("<HH")
+MOD = struct.Struct("<HHhHH")
+GEN = struct.Struct("<HH")
+INST = struct.Struct("<20sH")
+SHDR = struct.Struct("<20sIIIIIBbHH")
+
+logger = logging.getLogger(__name__)
+_hash_lock = threading.Lock()
+
+
+# ---- RIFF ----
+def iter_chunks(data, start, end):
+    while start + 8 <= end:
+        chunk_id = bytes(data[start:start + 4])
+        size = struct.unpack_from("<I", data, start + 4)[0]
+        yield chunk_id, start + 8, size
+        start += 8 + size + (size & 1)
+
+
+def riff_chunk(chunk_id, payload):
+    return chunk_id + struct.pack("<I", len(payload)) + payload + (b"\0" if len(payload) & 1 else b"")
+
+
+def read_sf2(data):
+    # Returns the raw INFO list and the sdta/pdta sub-chunks as (offset, size).
+    if bytes(data[:4]) != b"RIFF" or bytes(data[8:12]) != b"sfbk":
+        raise ValueError("not a SoundFont 2 file")
+    info = None
+    chunks = {}
+    for chunk_id, offset, size in iter_chunks(data, 12, 8 + struct.unpack_from("<I", data, 4)[0]):
+        if chunk_id != b"LIST":
+            continue
+        list_type = bytes(data[offset:offset + 4])
+        if list_type == b"INFO":
+            info = bytes(data[offset - 8:offset + size])
+        for sub_id, sub_offset, sub_size in iter_chunks(data, offset + 4, offset + size):
+            chunks[sub_id] = (sub_offset, sub_size)
+    missing = {b"phdr", b"pbag", b"pmod", b"pgen", b"inst", b"ibag", b"imod", b"igen", b"shdr", b"smpl"} - set(chunks)
+    if info is None or missing:
+        raise ValueError(f"incomplete SoundFont 2 file, missing {sorted(missing)}")
+    return info, chunks
+
+
+def records(data, chunks, chunk_id, layout):
+    offset, size = chunks[chunk_id]
+    return list(layout.iter_unpack(data[offset:offset + size - size % layout.size]))
+
+
+# ---- Subsetting ----
+def copy_zones(bags, gens, mods, first_bag, last_bag, remap_oper, remap, out_bags, out_gens, out_mods):
+    # Appends the zones [first_bag, last_bag) with the generator remap_oper's
+    # amount translated through remap; returns the index of the first new bag.
+    start = len(out_bags)
+    for bag in range(first_bag, last_bag):
+        out_bags.append((len(out_gens), len(out_mods)))
+        out_mods.extend(mods[bags[bag][1]:bags[bag + 1][1]])
+        for oper, amount in gens[bags[bag][0]:bags[bag + 1][0]]:
+            out_gens.append((oper, remap[amount] if oper == remap_oper else amount))
+    return start
+
+
+def subset_sf2(source, programs, destination):
+    # Writes a SoundFont with only the presets in `programs`, a set of
+    # (bank, program) pairs, plus the instruments and samples they use.
+    with open(source, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        info, chunks = read_sf2(data)
+        phdr = records(data, chunks, b"phdr", PHDR)
+        pbag, pmod, pgen = (records(data, chunks, b"pbag", BAG), records(data, chunks, b"pmod", MOD),
+                            records(data, chunks, b"pgen", GEN))
+        inst = records(data, chunks, b"inst", INST)
+        ibag, imod, igen = (records(data, chunks, b"ibag", BAG), records(data, chunks, b"imod", MOD),
+                            records(data, chunks, b"igen", GEN))
+        shdr = records(data, chunks, b"shdr", SHDR)
+
+        presets = [i for i in range(len(phdr) - 1) if (phdr[i][2], phdr[i][1]) in programs]
+        used_inst = sorted({amount for i in presets for bag in range(phdr[i][3], phdr[i + 1][3])
+                            for oper, amount in pgen[pbag[bag][0]:pbag[bag + 1][0]] if oper == GEN_INSTRUMENT})
+        used_samples = {amount for i in used_inst for bag in range(inst[i][1], inst[i + 1][1])
+                        for oper, amount in igen[ibag[bag][0]:ibag[bag + 1][0]] if oper == GEN_SAMPLE_ID}
+        pending = list(used_samples)
+        while pending:  # Stereo pairs need their partner sample too
+            sample = shdr[pending.pop()]
+            if sample[9] & 0x7FFF in LINKED_SAMPLE_TYPES and sample[8] not in used_samples:
+                used_samples.add(sample[8])
+                pending.append(sample[8])
+        used_samples = sorted(used_samples)
+
+        # Sample data: each kept sample is copied with its padding and its
+        # offsets and loop points shifted to the new position.
+        smpl_offset = chunks[b"smpl"][0]
+        sm24 = chunks.get(b"sm24")
+        smpl, smpl24, headers = bytearray(), bytearray(), []
+        sample_map = {old: new for new, old in enumerate(used_samples)}
+        for old in used_samples:
+            name, start, end, loop_start, loop_end, rate, pitch, correction, link, kind = shdr[old]
+            shift = len(smpl) // 2 - start
+            smpl += data[smpl_offset + start * 2:smpl_offset + end * 2] + bytes(SAMPLE_PADDING * 2)
+            if sm24:
+                smpl24 += data[sm24[0] + start:sm24[0] + end] + bytes(SAMPLE_PADDING)
+            headers.append((name, start + shift, end + shift, loop_start + shift, loop_end + shift, rate, pitch,
+                            correction, sample_map.get(link, 0), kind))
+        headers.append((b"EOS", 0, 0, 0, 0, 0, 0, 0, 0, 0))
+
+        inst_map = {old: new for new, old in enumerate(used_inst)}
+        new_inst, new_ibag, new_igen, new_imod = [], [], [], []
+        for old in used_inst:
+            first = copy_zones(ibag, igen, imod, inst[old][1], inst[old + 1][1], GEN_SAMPLE_ID, sample_map,
+                               new_ibag, new_igen, new_imod)
+            new_inst.append((inst[old][0], first))
+        new_inst.append((b"EOI", len(new_ibag)))
+        new_ibag.append((len(new_igen), len(new_imod)))
+
+        new_phdr, new_pbag, new_pgen, new_pmod = [], [], [], []
+        for old in presets:
+            first = copy_zones(pbag, pgen, pmod, phdr[old][3], phdr[old + 1][3], GEN_INSTRUMENT, inst_map,
+                               new_pbag, new_pgen, new_pmod)
+            new_phdr.append(phdr[old][:3] + (first,) + phdr[old][4:])
+        new_phdr.append((b"EOP", 0, 0, len(new_pbag), 0, 0, 0))
+        new_pbag.append((len(new_pgen), len(new_pmod)))
+
+    def table(layout, rows):
+        return b"".join(layout.pack(*row) for row in rows)
+
+    terminal_mod, terminal_gen = [(0, 0, 0, 0, 0)], [(0, 0)]
+    sdta = [riff_chunk(b"smpl", bytes(smpl))] + ([riff_chunk(b"sm24", bytes(smpl24))] if sm24 else [])
+    pdta = [
+        riff_chunk(b"phdr", table(PHDR, new_phdr)),
+        riff_chunk(b"pbag", table(BAG, new_pbag)),
+        riff_chunk(b"pmod", table(MOD, new_pmod + terminal_mod)),
+        riff_chunk(b"pgen", table(GEN, new_pgen + terminal_gen)),
+        riff_chunk(b"inst", table(INST, new_inst)),
+        riff_chunk(b"ibag", table(BAG, new_ibag)),
+        riff_chunk(b"imod", table(MOD, new_imod + terminal_mod)),
+        riff_chunk(b"igen", table(GEN, new_igen + terminal_gen)),
+        riff_chunk(b"shdr", table(SHDR, headers)),
+    ]
+    body = (b"sfbk" + info + riff_chunk(b"LIST", b"sdta" + b"".join(sdta))
+            + riff_chunk(b"LIST", b"pdta" + b"".join(pdta)))
+    tmp_path = f"{destination}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(riff_chunk(b"RIFF", body))
+    os.replace(tmp_path, destination)
+    return {"presets": len(presets), "instruments": len(used_inst), "samples": len(used_samples)}
+
+
+# ---- Cache ----
+def source_hash(path, cache_dir=SUBSET_DIR):
+    # Content hash of the source bank, remembered per (path, size, mtime) so
+    # the large file is only read in full when it changes.
+    index_path = os.path.join(cache_dir, "sources.json")
+    identity = soundfont_identity(path)
+    with _hash_lock:
+        try:
+            with open(index_path) as f:
+                index = json.load(f)
+        except (OSError, ValueError):
+            index = {}
+        if identity not in index:
+            digest = hashlib.sha256()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+            index[identity] = digest.hexdigest()
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(index, f)
+            os.replace(tmp_path, index_path)
+        return index[identity]
+
+
+def subset_path(programs, source=SOUNDFONT_PATH, cache_dir=SUBSET_DIR):
+    # Cached subset for a set of GM programs (bank 0), built on first use.
+    os.makedirs(cache_dir, exist_ok=True)
+    wanted = sorted({(0, program) for program in programs})
+    programs_hash = hashlib.sha256(json.dumps(wanted).encode()).hexdigest()[:16]
+    path = os.path.join(cache_dir, f"{source_hash(source, cache_dir)[:16]}_{programs_hash}.sf2")
+    if not os.path.exists(path):
+        stats = subset_sf2(source, set(wanted), path)
+        logger.info("Built soundfont subset %s: %s", path, stats)
+    return path
+
+
+def style_programs(style):
+    # Everything LoopGen can select for the style, including its fallbacks.
+    instruments = INSTRUMENT_SETS.get(style, [0])
+    return set(instruments) | set(loop_programs([])) | set(loop_programs(instruments[:1]))
+
+
+def style_soundfont(style, source=SOUNDFONT_PATH, cache_dir=SUBSET_DIR):
+    return programs_soundfont(style_programs(style), source, cache_dir)
+
+
+def programs_soundfont(programs, source=SOUNDFONT_PATH, cache_dir=SUBSET_DIR):
+    # The programs' subset, or the full bank if it cannot be built.
+    try:
+        return subset_path(programs, source, cache_dir)
+    except (OSError, ValueError, struct.error, IndexError) as exc:
+        logger.warning("Using the full soundfont, subsetting %s failed: %s", source, exc)
+        return source
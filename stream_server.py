@@ -0,0 +1,478 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import struct
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import numpy as np
+from day_planner import day_segments, load_manifest
+from loop_cache import LoopCache, events_cache_key
+from loopgen import stream_session
+from mixer import LoopMixer
+from quality import QualityGovernor
+from music_params import CATALOG_VARIANTS, GOALS, STYLES, derive_seed, generate_music_parameters
+from renderer import TAIL_SECONDS, init_worker, read_wav, render_events
+from segment_ring import DEFAULT_RING_BYTES, SegmentRing
+from synth_engine import SOUNDFONT_PATH
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+SAMPLE_RATE = 44100
+CHANNELS = 2
+CHUNK_BYTES = 64 * 1024
+PREFETCH_SECTIONS = 1  # Rendered sections buffered per session beyond the one streaming
+WRITE_BUFFER_HIGH = 4 * CHUNK_BYTES
+LIVE_LEAD_SECONDS = 30.0  # How far a live channel renders ahead of real time
+LIVE_POLL_SECONDS = 0.05
+LIVE_RETRY_SECONDS = 1.0  # Pause after a failed render before a live channel tries the next section
+LIVE_SEGMENT_SECONDS = 1.0  # Live audio is appended in pieces this long as real time reaches them
+RING_SEGMENTS = 8  # At least this many live segments fit the ring, so listeners have slack behind the writer
+RENDER_CACHE_BYTES = 64 * 1024 * 1024  # Seeded section renders kept in memory
+
+logger = logging.getLogger(__name__)
+
+
+def wav_stream_header(sample_rate=SAMPLE_RATE, channels=CHANNELS):
+    # Sizes are unknown for an endless stream; 0xFFFFFFFF is the usual marker.
+    byte_rate = sample_rate * channels * 2
+    return (b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVE"
+            + b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, sample_rate, byte_rate, channels * 2, 16)
+            + b"data" + struct.pack("<I", 0xFFFFFFFF))
+
+
+# ---- Render Workers ----
+def render_worker(events, sample_rate, level=0):
+    result, cpu_seconds = render_events(events, sample_rate, level)
+    return result.pcm.tobytes(), result.audio_seconds, cpu_seconds
+
+
+def session_sections(params_iter):
+    # (params, section events, whether the section ends its loop). Every section
+    # carries its program changes, so any worker can render it.
+    sections = stream_session(params_iter, standalone=True)
+    current = next(sections, None)
+    while current is not None:
+        following = next(sections, None)
+        yield current + (following is None or following[0] is not current[0],)
+        current = following
+
+
+# ---- Sessions ----
+class ListenerSession:
+    def __init__(self, server, goal, style, hour, seed=None, max_loops=None):
+        self.server = server
+        self.goal = goal
+        self.style = style
+        self.hour = hour
+        self.seed = seed
+        self.max_loops = max_loops
+        self.sample_rate = server.sample_rate
+
+    def loop_params(self):
+        hour = self.hour
+        loop_index = 0
+        while self.max_loops is None or loop_index < self.max_loops:
+            seed = derive_seed(self.goal, self.style, hour, self.seed + loop_index) if self.seed is not None else None
+            yield generate_music_parameters(self.goal, self.style, hour, seed)
+            hour = (hour + 1) % 24
+            loop_index += 1
+
+    async def pieces(self):
+        # (int16 PCM, bpm, whether it ends its loop) per section, each rendered
+        # on the server's pool by itself so a long loop is never held whole.
+        for params, events, ends_loop in session_sections(self.loop_params()):
+            pcm = await self.server.render(events, cached=self.seed is not None)
+            yield np.frombuffer(pcm, dtype=np.int16), params["bpm"], ends_loop
+
+    async def produce(self, queue):
+        mixer = LoopMixer(self.sample_rate)
+        try:
+            async for pcm, bpm, ends_loop in self.pieces():
+                # Blocks while the client is behind: backpressure
+                await queue.put(mixer.add(pcm, bpm, ends_loop).tobytes())
+            await queue.put(mixer.flush().tobytes())
+            await queue.put(None)
+        except Exception as exc:
+            await queue.put(exc)  # Raised by chunks(), so the response ends instead of waiting forever
+
+    async def chunks(self):
+        queue = asyncio.Queue(maxsize=PREFETCH_SECTIONS)
+        producer = asyncio.create_task(self.produce(queue))
+        try:
+            while True:
+                pcm = await queue.get()
+                if pcm is None:
+                    break
+                if isinstance(pcm, Exception):
+                    raise pcm
+                view = memoryview(pcm)
+                for offset in range(0, len(view), CHUNK_BYTES):
+                    yield view[offset:offset + CHUNK_BYTES]
+        finally:
+            producer.cancel()
+
+
+class DaySession(ListenerSession):
+    """Plays a schedule pre-rendered by day_planner.render_day from its WAVs,
+    so nothing is rendered while streaming."""
+
+    def __init__(self, server, day_dir, start_index=0, max_loops=None):
+        self.server = server
+        self.day_dir = day_dir
+        self.start_index = start_index
+        self.max_loops = max_loops
+        self.sample_rate = load_manifest(day_dir)["sample_rate"]
+
+    async def pieces(self):
+        segments = itertools.islice(day_segments(self.day_dir, self.start_index), self.max_loops)
+        for segment in segments:
+            pcm, _ = await asyncio.to_thread(read_wav, os.path.join(self.day_dir, segment["wav"]))
+            yield pcm, segment["bpm"], True
+
+
+class LiveChannel:
+    """One endless stream per (goal, style), rendered once into a segment ring
+    and read by every listener. Segments are appended on a wall-clock timeline,
+    a little ahead of it, and late joiners start at the segment playing now."""
+
+    def __init__(self, server, goal, style, ring_path, ring_bytes=DEFAULT_RING_BYTES):
+        self.server = server
+        self.goal = goal
+        self.style = style
+        self.ring = SegmentRing(ring_path, ring_bytes, sample_rate=server.sample_rate)
+        self.listeners = 0
+        self.started = None  # Event loop time at which stream frame 0 played
+        self.task = asyncio.create_task(self.produce())
+
+    def loop_params(self):
+        # The seeded catalog variants, so renders are shared through the cache.
+        hour = time.localtime().tm_hour
+        for loop_index in itertools.count():
+            variant = (loop_index // 24) % CATALOG_VARIANTS
+            yield generate_music_parameters(self.goal, self.style, hour,
+                                            derive_seed(self.goal, self.style, hour, variant))
+            hour = (hour + 1) % 24
+
+    async def produce(self):
+        loop = asyncio.get_running_loop()
+        sample_rate = self.server.sample_rate
+        mixer = LoopMixer(sample_rate)
+        self.started = loop.time()
+        position = 0  # Stream frames appended so far
+        segment_frames = max(1, min(int(LIVE_SEGMENT_SECONDS * sample_rate),
+                                    self.ring.data_bytes // (RING_SEGMENTS * self.ring.frame_bytes)))
+        for params, events, ends_loop in session_sections(self.loop_params()):
+            try:
+                pcm = await self.server.render(events, cached=True)
+                mixed = mixer.add(np.frombuffer(pcm, dtype=np.int16), params["bpm"], ends_loop)
+            except Exception:
+                # The channel outlives a bad section; its listeners just wait for the next one.
+                logger.exception("Live channel %s/%s failed to render a %s section", self.goal, self.style,
+                                 params["key"])
+                await asyncio.sleep(LIVE_RETRY_SECONDS)
+                continue
+            for start in range(0, len(mixed), segment_frames):
+                due = self.started + position / sample_rate
+                if due < loop.time():
+                    # Renders fell behind: the timeline resumes from here rather than skipping audio.
+                    self.started += loop.time() - due
+                else:
+                    await asyncio.sleep(max(0.0, due - LIVE_LEAD_SECONDS - loop.time()))
+                segment = mixed[start:start + segment_frames]
+                self.ring.append(segment, params["key"], params["bpm"], params["circadian_phase"])
+                position += len(segment)
+
+    def playing(self):
+        # Segment of the stream that is due now, None until there is one.
+        if self.started is None:
+            return None
+        elapsed = asyncio.get_running_loop().time() - self.started
+        return self.ring.at(int(max(0.0, elapsed) * self.ring.sample_rate))
+
+    async def chunks(self, is_closed=lambda: False):
+        # is_closed lets a listener that hung up between segments leave without
+        # waiting for a write to fail.
+        ring = self.ring
+        seq = self.playing()
+        while seq is None and not is_closed():
+            await asyncio.sleep(LIVE_POLL_SECONDS)
+            seq = self.playing()
+        while not is_closed():
+            found = ring.view(seq)
+            if found is None:
+                if seq < ring.oldest():
+                    seq = self.playing()  # Fell a whole ring behind: rejoin where the stream is now
+                else:
+                    await asyncio.sleep(LIVE_POLL_SECONDS)
+                continue
+            _, view = found
+            try:
+                for offset in range(0, len(view), CHUNK_BYTES):
+                    chunk = bytes(view[offset:offset + CHUNK_BYTES])  # The transport may hold on to what it is given
+                    if not ring.valid(seq):
+                        break
+                    yield chunk
+            finally:
+                view.release()
+            seq += 1
+
+    def close(self):
+        self.task.cancel()
+        try:
+            self.ring.close(remove=True)
+        except BufferError:
+            os.remove(self.ring.path)  # A listener still holds a view; the mapping goes when it does
+
+
+
+# ---- Server ----
+class StreamServer:
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, workers=None, sample_rate=SAMPLE_RATE,
+                 ring_dir=None, ring_bytes=DEFAULT_RING_BYTES, day_dir=None, cache_dir=None):
+        self.host = host
+        self.port = port
+        self.workers = workers or os.cpu_count() or 1
+        self.sample_rate = sample_rate
+        self.pool = None
+        self.server = None
+        self.active_sessions = 0
+        self.total_sessions = 0
+        self.audio_seconds = 0.0
+        self.render_cpu_seconds = 0.0
+        self.ring_dir = ring_dir
+        self.ring_bytes = ring_bytes
+        self.live = {}  # (goal, style) -> LiveChannel
+        self.day_dir = day_dir  # render_day output served on /day
+        self.day_sessions = 0
+        self.quality = QualityGovernor(name="stream quality")
+        self.cache = LoopCache(directory=cache_dir, max_memory_bytes=RENDER_CACHE_BYTES)  # Seeded section renders
+
+    async def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker,
+                                        initargs=(self.sample_rate,))
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info("Streaming on http://%s:%d/stream with %d render workers", self.host, self.port, self.workers)
+
+    async def close(self):
+        for channel in self.live.values():
+            channel.close()
+        self.live.clear()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+        if self.pool:
+            self.pool.shutdown(cancel_futures=True)
+
+    def render_streams(self):
+        # Streams that each need their own real-time renders: one per /stream
+        # session, one per live channel however many listen to it, none for /day.
+        live_listeners = sum(channel.listeners for channel in self.live.values())
+        return self.active_sessions - live_listeners - self.day_sessions + len(self.live)
+
+    async def render(self, events, cached=False):
+        # cached: the events are reproducible (seeded), so the render is worth keeping.
+        loop = asyncio.get_running_loop()
+        level = self.quality.level
+        key = None
+        if cached:
+            key = events_cache_key(events, SOUNDFONT_PATH, {"sample_rate": self.sample_rate,
+                                                             "tail_seconds": TAIL_SECONDS, "level": level})
+            pcm = await asyncio.to_thread(self.cache.get, key)
+            if pcm is not None:
+                return pcm
+        pcm, audio_seconds, cpu_seconds = await loop.run_in_executor(
+            self.pool, render_worker, events, self.sample_rate, level)
+        self.audio_seconds += audio_seconds
+        self.render_cpu_seconds += cpu_seconds
+        if audio_seconds:
+            # Share of the pool's real-time budget the current streams need at this level.
+            self.quality.observe(cpu_seconds / audio_seconds * max(1, self.render_streams()) / self.workers)
+        if key is not None:
+            await asyncio.to_thread(self.cache.put, key, pcm)
+        return pcm
+
+    def stats(self):
+        # One core renders audio_seconds / cpu_seconds of audio per second, so
+        # that is how many real-time listeners it can sustain.
+        per_core = self.audio_seconds / self.render_cpu_seconds if self.render_cpu_seconds else None
+        return {
+            "active_sessions": self.active_sessions,
+            "total_sessions": self.total_sessions,
+            "workers": self.workers,
+            "audio_seconds": round(self.audio_seconds, 3),
+            "render_cpu_seconds": round(self.render_cpu_seconds, 3),
+            "sessions_per_core": round(per_core, 2) if per_core else None,
+            "estimated_capacity": round(per_core * self.workers, 1) if per_core else None,
+            "live_channels": {f"{goal}/{style}": channel.listeners for (goal, style), channel in self.live.items()},
+            "quality": self.quality.settings["name"],
+            "quality_changes": self.quality.changes,
+            "render_cache": self.cache.stats(),
+        }
+
+    async def handle_client(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode("latin-1").strip()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # Headers are not needed
+            method, target, _ = (request_line.split(" ") + ["", "", ""])[:3]
+            url = urlsplit(target)
+            query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+            if method != "GET":
+                await self.respond(writer, 405, "Method Not Allowed")
+            elif url.path == "/stats":
+                await self.respond(writer, 200, json.dumps(self.stats()), "application/json")
+            elif url.path == "/stream":
+                await self.stream(writer, query)
+            elif url.path == "/live":
+                await self.stream_live(writer, query)
+            elif url.path == "/day" and self.day_dir:
+                await self.stream_day(writer, query)
+            else:
+                await self.respond(writer, 404, "Not Found")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception:
+            # The connection closes without the final chunk, so the client sees the stream was cut short.
+            logger.exception("Request failed")
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, body, content_type="text/plain"):
+        data = body.encode()
+        writer.write(f"HTTP/1.1 {status} {'OK' if status == 200 else body}\r\n"
+                     f"Content-Type: {content_type}\r\nContent-Length: {len(data)}\r\n"
+                     "Connection: close\r\n\r\n".encode() + data)
+        await writer.drain()
+
+    async def stream(self, writer, query):
+        goal = query.get("goal", "Focus")
+        style = query.get("style", "Ambient")
+        if goal not in GOALS or style not in STYLES:
+            await self.respond(writer, 400, "Bad Request")
+            return
+        try:
+            hour = int(query.get("hour", 7)) % 24
+            seed = int(query["seed"]) if "seed" in query else None
+            max_loops = int(query["loops"]) if "loops" in query else None
+        except ValueError:
+            await self.respond(writer, 400, "Bad Request")
+            return
+        await self.send_session(writer, ListenerSession(self, goal, style, hour, seed, max_loops))
+
+    async def stream_day(self, writer, query):
+        try:
+            start_index = int(query.get("start", 0))
+            max_loops = int(query["loops"]) if "loops" in query else None
+        except ValueError:
+            await self.respond(writer, 400, "Bad Request")
+            return
+        self.day_sessions += 1
+        try:
+            await self.send_session(writer, DaySession(self, self.day_dir, start_index, max_loops))
+        finally:
+            self.day_sessions -= 1
+
+    async def send_session(self, writer, session):
+        # A small transport buffer makes drain() wait on slow clients.
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: audio/wav\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        self.active_sessions += 1
+        self.total_sessions += 1
+        chunks = session.chunks()
+        try:
+            await self.write_chunk(writer, wav_stream_header(session.sample_rate))
+            async for chunk in chunks:
+                await self.write_chunk(writer, chunk)
+            writer.write(b"0\r\n\r\n")
+            await writer.drain()
+        finally:
+            await chunks.aclose()  # Stops the session's renders if the client went away
+            self.active_sessions -= 1
+
+    async def stream_live(self, writer, query):
+        goal = query.get("goal", "Focus")
+        style = query.get("style", "Ambient")
+        if goal not in GOALS or style not in STYLES:
+            await self.respond(writer, 400, "Bad Request")
+            return
+
+        channel = self.live.get((goal, style))
+        if channel is None:
+            ring_dir = self.ring_dir or tempfile.gettempdir()
+            ring_path = os.path.join(ring_dir, f"moodring_live_{os.getpid()}_{time.time_ns()}.ring")
+            channel = self.live[(goal, style)] = LiveChannel(self, goal, style, ring_path, self.ring_bytes)
+        channel.listeners += 1
+        self.active_sessions += 1
+        self.total_sessions += 1
+        writer.transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: audio/wav\r\n"
+                     b"Transfer-Encoding: chunked\r\nConnection: close\r\n\r\n")
+        chunks = channel.chunks(writer.is_closing)
+        try:
+            await self.write_chunk(writer, wav_stream_header(self.sample_rate))
+            async for chunk in chunks:
+                await self.write_chunk(writer, chunk)
+        finally:
+            await chunks.aclose()
+            self.active_sessions -= 1
+            channel.listeners -= 1
+            if channel.listeners == 0 and self.live.get((goal, style)) is channel:
+                del self.live[(goal, style)]
+                channel.close()
+
+    async def write_chunk(self, writer, data):
+        writer.write(b"%X\r\n" % len(data))
+        writer.write(data)
+        writer.write(b"\r\n")
+        await writer.drain()
+
+
+# ---- Local Client ----
+async def read_stream(host, port, path, max_bytes=None):
+    # Minimal chunked-transfer client, enough to exercise the server locally.
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+    await writer.drain()
+    status = (await reader.readline()).decode()
+    while (await reader.readline()) not in (b"\r\n", b""):
+        pass
+    body = bytearray()
+    try:
+        if " 200 " not in status:
+            return status, await reader.read()
+        while max_bytes is None or len(body) < max_bytes:
+            size = int((await reader.readline()).strip() or b"0", 16)
+            if size == 0:
+                break
+            body += await reader.readexactly(size)
+            await reader.readexactly(2)
+    finally:
+        writer.close()
+    return status, bytes(body)
+
+
+async def load_test(clients=4, seconds=30.0, workers=None, goal="Focus", style="Ambient"):
+    server = StreamServer(port=0, workers=workers)
+    await server.start()
+    bytes_per_second = SAMPLE_RATE * CHANNELS * 2
+    started = time.perf_counter()
+    try:
+        paths = ["/stream?" + urlencode({"goal": goal, "style": style, "hour": (7 + i) % 24, "seed": i})
+                 for i in range(clients)]
+        results = await asyncio.gather(*(read_stream(server.host, server.port, path, int(seconds * bytes_per_second))
+                                         for path in paths))
+        elapsed = time.perf_counter() - started
+        stats = server.stats()
+    finally:
+        await server.close()
+    stats.update(clients=clients, wall_seconds=round(elapsed, 3),
+                 streamed_audio_seconds=round(sum(len(body) for _, body in results) / bytes_per_second, 3))
+    return stats
@@ -0,0 +1,390 @@
+import atexit
+import ctypes
+import threading
+import time
+from collections import deque
+from midi_events import NOTE_OFF, NOTE_ON, PROGRAM_CHANGE
+
+SOUNDFONT_PATH = "soundfonts/FluidR3_GM.sf2"
+DEFAULT_DRIVER = "coreaudio"
+MIDI_CHANNELS = 16
+SYNTH_MIDI_CHANNELS = 256    # Channels the synth is created with, split into session banks
+BANK_CHANNELS = 3            # chord, melody, bass
+DRUM_CHANNEL = 9             # GM percussion, in every block of 16 channels
+BANK_VOLUME = 100            # GM default channel volume (CC 7)
+SEQUENCER_TIME_SCALE = 1000  # Sequencer ticks per second
+SCHEDULE_LEAD_TICKS = 50     # Head start for the first loop so its opening events are not late
+
+
+class SynthEngine:
+    """Long-lived FluidSynth instance: soundfonts are loaded once and channel
+    programs stay selected between loops."""
+
+    def __init__(self, driver=DEFAULT_DRIVER, sample_rate=44100, soundfont=SOUNDFONT_PATH):
+        import fluidsynth
+
+        self.driver = driver
+        self.sample_rate = sample_rate
+        self.soundfont = soundfont  # Bank programs are selected from unless told otherwise
+        self.lock = threading.RLock()
+        self.fs = fluidsynth.Synth(samplerate=float(sample_rate), channels=SYNTH_MIDI_CHANNELS)
+        if driver:
+            self.fs.start(driver=driver)
+        self.soundfonts = {}        # path -> sfid
+        self.channel_programs = {}  # channel -> (sfid, bank, program)
+        self.sequencer = None
+        self.synth_dest = None
+        self.jitter_ticks = deque(maxlen=512)
+        self.jitter_total = 0  # Wake-ups measured so far, for reading only the newest jitter samples
+        self.remove_events = None  # fluid_sequencer_remove_events, if the library has it
+        self.program_select_event = None  # fluid_event_program_select
+        usable = [c for c in range(SYNTH_MIDI_CHANNELS) if c % MIDI_CHANNELS != DRUM_CHANNEL]
+        self.bank_layout = [usable[i:i + BANK_CHANNELS] for i in range(0, len(usable) - BANK_CHANNELS + 1, BANK_CHANNELS)]
+        self.banks = []  # ChannelBank per block handed out so far, reused once released
+        self.quality_requests = {}  # bank index -> settings
+        self.running = True
+
+    def load_soundfont(self, path=SOUNDFONT_PATH):
+        with self.lock:
+            sfid = self.soundfonts.get(path)
+            if sfid is None:
+                sfid = self.fs.sfload(path)
+                if sfid == -1:
+                    raise RuntimeError(f"Could not load soundfont: {path}")
+                self.soundfonts[path] = sfid
+            return sfid
+
+    def set_soundfont(self, path):
+        # Switch the default bank, unloading the others so only one stays resident.
+        sfid = self.load_soundfont(path)
+        with self.lock:
+            self.soundfont = path
+            self.unload_soundfonts({path})
+        return sfid
+
+    def unload_soundfonts(self, keep):
+        with self.lock:
+            for path, sfid in list(self.soundfonts.items()):
+                if path not in keep:
+                    self.fs.sfunload(sfid)
+                    del self.soundfonts[path]
+            kept = set(self.soundfonts.values())
+            self.channel_programs = {channel: selected for channel, selected in self.channel_programs.items()
+                                     if selected[0] in kept}
+
+    def set_sample_rate(self, sample_rate):
+        # Changes a driverless synth's rate in place, keeping its soundfonts.
+        # False if the library cannot, in which case a new synth is needed.
+        import fluidsynth
+
+        set_rate = fluidsynth.cfunc("fluid_synth_set_sample_rate", None,
+                                    ("synth", ctypes.c_void_p, 1), ("sample_rate", ctypes.c_float, 1))
+        if set_rate is None:
+            return False
+        with self.lock:
+            set_rate(self.fs.synth, float(sample_rate))
+            self.sample_rate = sample_rate
+        return True
+
+    def apply_quality(self, settings):
+        # Real-time settings only; an audio driver's sample rate is fixed for the life of a synth.
+        with self.lock:
+            self.fs.setting("synth.polyphony", int(settings["polyphony"]))
+            self.fs.setting("synth.reverb.active", int(settings["reverb"]))
+            self.fs.setting("synth.chorus.active", int(settings["chorus"]))
+
+    def request_quality(self, bank, settings):
+        # Sessions share the synth's voices and effects, so the most
+        # constrained session's request applies to all of them.
+        with self.lock:
+            self.quality_requests[bank.index] = settings
+            self.apply_requested_quality()
+
+    def apply_requested_quality(self):
+        with self.lock:
+            requests = list(self.quality_requests.values())
+            if requests:
+                self.apply_quality({"polyphony": min(r["polyphony"] for r in requests),
+                                    "reverb": all(r["reverb"] for r in requests),
+                                    "chorus": all(r["chorus"] for r in requests)})
+
+    def select_program(self, channel, program, bank=0, soundfont=None):
+        sfid = self.load_soundfont(soundfont or self.soundfont)
+        with self.lock:
+            if self.channel_programs.get(channel) != (sfid, bank, program):
+                self.fs.program_select(channel, sfid, bank, program)
+                self.channel_programs[channel] = (sfid, bank, program)
+
+    def noteon(self, channel, note, velocity):
+        self.fs.noteon(channel, note, velocity)
+
+    def noteoff(self, channel, note):
+        self.fs.noteoff(channel, note)
+
+    def send_event(self, channel, event_type, note, velocity):
+        if event_type == NOTE_ON:
+            self.fs.noteon(channel, note, velocity)
+        elif event_type == NOTE_OFF:
+            self.fs.noteoff(channel, note)
+        elif event_type == PROGRAM_CHANGE:
+            self.select_program(channel, note)
+
+    # ---- Channel Banks ----
+    def active_banks(self):
+        with self.lock:
+            return [bank for bank in self.banks if bank.active]
+
+    def acquire_bank(self, soundfont=None):
+        # A free block of channels for one session. A released bank is reused
+        # once nothing it scheduled can still reach its channels.
+        with self.lock:
+            now = self.now()
+            bank = next((bank for bank in self.banks if not bank.active and bank.busy_until <= now), None)
+            if bank is None:
+                if len(self.banks) == len(self.bank_layout):
+                    raise RuntimeError(f"All {len(self.bank_layout)} channel banks are in use")
+                bank = ChannelBank(self, len(self.banks), self.bank_layout[len(self.banks)])
+                self.banks.append(bank)
+            bank.soundfont = soundfont or self.soundfont
+            self.load_soundfont(bank.soundfont)
+            bank.active = True
+            self.reset(bank.channels, hard=True)
+            for channel in bank.channels:
+                self.fs.cc(channel, 7, BANK_VOLUME)
+            return bank
+
+    def cancel_bank(self, bank):
+        # Drop what the bank still has queued and silence its channels, leaving
+        # the other sessions' events alone. The events are removed outside the
+        # engine lock, so the sequencer's lock is never taken while holding it.
+        with self.lock:
+            sequencer, source, remove_events = self.sequencer, bank.source, self.remove_events
+            for channel in bank.channels:
+                self.fs.cc(channel, 7, 0)  # Mutes anything that could not be removed
+        if sequencer is not None and source is not None and remove_events is not None:
+            remove_events(sequencer.sequencer, source, -1, -1)
+            bank.busy_until = 0
+        self.reset(bank.channels, hard=True)
+
+    def release_bank(self, bank):
+        self.cancel_bank(bank)
+        with self.lock:
+            bank.active = False
+            if self.quality_requests.pop(bank.index, None) is not None:
+                self.apply_requested_quality()  # May step back up without this session's request
+            # Soundfonts only released sessions used are unloaded.
+            self.unload_soundfonts({self.soundfont} | {b.soundfont for b in self.banks if b.active})
+
+    def bank_source(self, bank):
+        # Sequencer client the bank's events are sent from, so they can be removed together.
+        with self.lock:
+            if bank.source is None:
+                bank.source = self.get_sequencer().register_client(f"bank_{bank.index}", self._on_bank_event)
+            return bank.source
+
+    def _on_bank_event(self, tick, event, seq, data):
+        pass  # Banks only send events
+
+    # ---- Sequencer ----
+    def get_sequencer(self):
+        with self.lock:
+            if self.sequencer is None:
+                import fluidsynth
+
+                # With an audio driver the sequencer is advanced by the synth's own
+                # sample clock, so events land on audio blocks rather than on
+                # Python wakeups. A driverless engine falls back to the system timer.
+                self.sequencer = fluidsynth.Sequencer(time_scale=SEQUENCER_TIME_SCALE,
+                                                      use_system_timer=not self.driver)
+                self.synth_dest = self.sequencer.register_fluidsynth(self.fs)
+                self.remove_events = fluidsynth.cfunc("fluid_sequencer_remove_events", None,
+                                                      ("seq", ctypes.c_void_p, 1), ("source", ctypes.c_short, 1),
+                                                      ("dest", ctypes.c_short, 1), ("type", ctypes.c_int, 1))
+                self.program_select_event = fluidsynth.cfunc("fluid_event_program_select", None,
+                                                             ("evt", ctypes.c_void_p, 1), ("channel", ctypes.c_int, 1),
+                                                             ("sfont_id", ctypes.c_uint, 1),
+                                                             ("bank_num", ctypes.c_short, 1),
+                                                             ("preset_num", ctypes.c_short, 1))
+                for bank in self.banks:
+                    bank.source = None
+            return self.sequencer
+
+    def now(self):
+        return self.get_sequencer().get_tick()
+
+    def schedule(self, events, start_tick=None, bank=None):
+        # Queue a whole loop (LoopEvents) on the sequencer with absolute timestamps
+        # and return the tick at which it ends, i.e. where the next loop should start.
+        # With a bank, the loop's channels 0-2 are played on the bank's channels.
+        seq = self.get_sequencer()
+        if start_tick is None:
+            start_tick = seq.get_tick() + SCHEDULE_LEAD_TICKS
+        source = self.bank_source(bank) if bank else -1
+        soundfont = bank.soundfont if bank else None
+        for seconds, channel, event_type, note, velocity in events.iter_timed():
+            tick = start_tick + int(round(seconds * SEQUENCER_TIME_SCALE))
+            if bank:
+                channel = bank.channels[channel % BANK_CHANNELS]
+            if event_type == NOTE_ON:
+                seq.note_on(tick, channel, note, velocity, source=source, dest=self.synth_dest)
+            elif event_type == NOTE_OFF:
+                seq.note_off(tick, channel, note, source=source, dest=self.synth_dest)
+            elif event_type == PROGRAM_CHANGE:
+                self.schedule_program(seq, tick, channel, note, soundfont, source)
+        end_tick = start_tick + self.duration_ticks(events)
+        if bank:
+            bank.busy_until = max(bank.busy_until, end_tick)
+        return end_tick
+
+    def duration_ticks(self, events):
+        return int(round(events.length * SEQUENCER_TIME_SCALE))
+
+    def schedule_program(self, seq, tick, channel, program, soundfont=None, source=-1):
+        # Program changes are sequencer events like the notes, applied on the
+        # synth's clock rather than from a Python callback.
+        import fluidsynth
+
+        sfid = self.load_soundfont(soundfont or self.soundfont)
+        evt = seq._create_event(source, self.synth_dest)
+        try:
+            self.program_select_event(evt, channel, sfid, 0, program)
+            seq._schedule_event(evt, tick)
+        finally:
+            fluidsynth.delete_fluid_event(evt)
+        with self.lock:
+            self.channel_programs.pop(channel, None)  # Selected by the sequencer from here on
+
+    def wait_until(self, tick, stop_event=None, check_interval=0.1):
+        # The jitter is how late the scheduling thread wakes for `tick`; the
+        # sequencer itself plays on the synth's clock.
+        while True:
+            now = self.now()
+            remaining = (tick - now) / SEQUENCER_TIME_SCALE
+            if remaining <= 0:
+                with self.lock:
+                    self.jitter_ticks.append(now - tick)
+                    self.jitter_total += 1
+                return True
+            if stop_event is not None:
+                if stop_event.wait(min(remaining, check_interval)):
+                    return False
+            else:
+                time.sleep(remaining)
+
+    def timing_stats(self):
+        with self.lock:
+            jitter = [t * 1000.0 / SEQUENCER_TIME_SCALE for t in self.jitter_ticks]
+        if not jitter:
+            return {"count": 0, "mean_ms": 0.0, "max_ms": 0.0}
+        return {"count": len(jitter), "mean_ms": sum(jitter) / len(jitter), "max_ms": max(jitter)}
+
+    def jitter_since(self, total):
+        # Jitter (ms) of the wake-ups measured after `total`, plus the new running total.
+        with self.lock:
+            fresh = min(self.jitter_total - total, len(self.jitter_ticks))
+            jitter = [t * 1000.0 / SEQUENCER_TIME_SCALE for t in list(self.jitter_ticks)[len(self.jitter_ticks) - fresh:]]
+            return jitter, self.jitter_total
+
+    def get_samples(self, frames):
+        # Only meaningful for an engine created without an audio driver.
+        return self.fs.get_samples(frames)
+
+    def reset(self, channels=None, hard=False):
+        # Release anything still sounding and reset controllers, but keep the
+        # selected programs so the next loop starts warm.
+        with self.lock:
+            for channel in channels if channels is not None else range(SYNTH_MIDI_CHANNELS):
+                if hard:
+                    self.fs.all_sounds_off(channel)
+                else:
+                    self.fs.all_notes_off(channel)
+                self.fs.cc(channel, 121, 0)
+
+    def shutdown(self):
+        with self.lock:
+            if not self.running:
+                return
+            self.running = False
+            sequencer, self.sequencer = self.sequencer, None
+        if sequencer is not None:
+            sequencer.delete()
+        with self.lock:
+            self.fs.delete()
+            self.soundfonts.clear()
+            self.channel_programs.clear()
+
+
+class ChannelBank:
+    """One session's block of channels on a shared SynthEngine.
+
+    Has the engine's playback interface, so a PlaybackController can use it in
+    place of the engine; loops keep their own channels 0-2 and are moved onto
+    the bank's block when scheduled. Cancelling touches only this bank.
+    """
+
+    def __init__(self, engine, index, channels):
+        self.engine = engine
+        self.index = index
+        self.channels = channels
+        self.soundfont = engine.soundfont
+        self.source = None  # Sequencer client id, registered on first schedule
+        self.busy_until = 0  # Last tick the bank has events queued for
+        self.active = False
+
+    def now(self):
+        return self.engine.now()
+
+    def schedule(self, events, start_tick=None):
+        return self.engine.schedule(events, start_tick, bank=self)
+
+    def wait_until(self, tick, stop_event=None, check_interval=0.1):
+        return self.engine.wait_until(tick, stop_event, check_interval)
+
+    def jitter_since(self, total):
+        return self.engine.jitter_since(total)
+
+    def apply_quality(self, settings):
+        self.engine.request_quality(self, settings)
+
+    def set_volume(self, volume):
+        with self.engine.lock:
+            for channel in self.channels:
+                self.engine.fs.cc(channel, 7, volume)
+
+    def release(self):
+        self.engine.release_bank(self)
+
+
+# ---- Shared Engine ----
+_shared_engine = None
+_shared_lock = threading.RLock()
+
+
+def get_shared_engine(driver=DEFAULT_DRIVER, soundfont=None):
+    # Created on first use and kept until the process exits, so the soundfont
+    # is loaded once. Its default soundfont only changes while no session plays.
+    global _shared_engine
+    with _shared_lock:
+        if _shared_engine is None or not _shared_engine.running:
+            _shared_engine = SynthEngine(driver=driver, soundfont=soundfont or SOUNDFONT_PATH)
+        elif soundfont and soundfont != _shared_engine.soundfont and not _shared_engine.active_banks():
+            _shared_engine.set_soundfont(soundfont)
+        return _shared_engine
+
+
+def acquire_shared_bank(driver=DEFAULT_DRIVER, soundfont=SOUNDFONT_PATH):
+    # A channel bank on the shared engine; give it back with bank.release().
+    # Its soundfont is always named, never whatever an earlier session left as the default.
+    with _shared_lock:
+        return get_shared_engine(driver, soundfont).acquire_bank(soundfont)
+
+
+def shutdown_shared_engine():
+    global _shared_engine
+    with _shared_lock:
+        if _shared_engine is not None:
+            _shared_engine.shutdown()
+            _shared_engine = None
+
+
+atexit.register(shutdown_shared_engine)
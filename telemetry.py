@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+METRIC_PREFIX = "moodring_loop_"
+
+
+def ms(seconds):
+    return round(seconds * 1000.0, 3)
+
+
+class Telemetry:
+    """Bounded ring buffer of per-loop timing records, safe to read from the UI
+    thread while playback threads write to it."""
+
+    def __init__(self, max_records=500, export_path=None):
+        self.records = deque(maxlen=max_records)
+        self.lock = threading.Lock()
+        self.count = 0
+        self.export_path = export_path  # *.prom is rewritten as Prometheus text, anything else appended as JSONL
+
+    def record(self, **fields):
+        entry = {"time": time.time(), **fields}
+        with self.lock:
+            self.count += 1
+            entry["loop"] = self.count
+            self.records.append(entry)
+        if self.export_path:
+            self.export(self.export_path, entry)
+        return entry
+
+    def snapshot(self):
+        with self.lock:
+            return [dict(entry) for entry in self.records]
+
+    def summary(self):
+        # Mean and max of every numeric field over the buffered records.
+        totals = {}
+        for entry in self.snapshot():
+            for name, value in entry.items():
+                if name not in ("time", "loop") and isinstance(value, (int, float)) and not isinstance(value, bool):
+                    totals.setdefault(name, []).append(value)
+        return {name: {"mean": round(sum(values) / len(values), 3), "max": round(max(values), 3)}
+                for name, values in totals.items()}
+
+    def prometheus_text(self):
+        with self.lock:
+            count = self.count
+        lines = [f"# TYPE {METRIC_PREFIX}total counter", f"{METRIC_PREFIX}total {count}"]
+        for name, stats in sorted(self.summary().items()):
+            metric = METRIC_PREFIX + name
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f'{metric}{{stat="mean"}} {stats["mean"]}')
+            lines.append(f'{metric}{{stat="max"}} {stats["max"]}')
+        return "\n".join(lines) + "\n"
+
+    def export(self, path, entry=None):
+        if path.endswith(".prom"):
+            # Written whole and swapped in, so a scraper never reads half a file.
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(self.prometheus_text())
+            os.replace(tmp_path, path)
+        else:
+            entries = [entry] if entry is not None else self.snapshot()
+            with open(path, "a") as f:
+                for item in entries:
+                    f.write(json.dumps(item) + "\n")
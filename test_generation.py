@@ -2,11 +2,11 @@ import streamlit as st
 import random
 import time
 import mido
-import fluidsynth
 import threading
-
-# ---- CONFIGURATION ----
-SOUNDFONT_PATH = "soundfonts/FluidR3_GM.sf2"  # Assumed location
+import queue
+from pipeline import Pipeline
+from sf2_subset import programs_soundfont
+from synth_engine import acquire_shared_bank
 
 # ---- App State ----
 if "looping" not in st.session_state:
@@ -39,7 +39,7 @@ def get_instrument_name(program_number):
     return GM_INSTRUMENT_NAMES.get(program_number, f"Program {program_number}")
 
 # ---- MIDI Generation ----
-def generate_midi_file(filename, bpm=120, scale=[60, 62, 64, 65, 67, 69, 71], instrument=0):
+def generate_midi(bpm=120, scale=[60, 62, 64, 65, 67, 69, 71], instrument=0):
     mid = mido.MidiFile()
     track = mido.MidiTrack()
     mid.tracks.append(track)
@@ -55,30 +55,21 @@ def generate_midi_file(filename, bpm=120, scale=[60, 62, 64, 65, 67, 69, 71], in
         track.append(mido.Message('note_on', note=note, velocity=80, time=0))
         track.append(mido.Message('note_off', note=note, velocity=80, time=duration_ticks))
 
-    mid.save(filename)
-    return mid.length  # Actual duration in seconds
-
-def play_midi_file(filename, instrument_program):
-    fs = fluidsynth.Synth()
-    fs.start(driver="coreaudio")
-    sfid = fs.sfload(SOUNDFONT_PATH)
-    fs.program_select(0, sfid, 0, instrument_program)
+    return mid  # Kept in memory; writing a file per loop grew without bound
 
-    mid = mido.MidiFile(filename)
+def play_midi(mid, instrument_program, bank):
+    engine, channel = bank.engine, bank.channels[0]
+    engine.select_program(channel, instrument_program)
     for msg in mid.play():
         if msg.type == 'note_on':
-            fs.noteon(0, msg.note, msg.velocity)
+            engine.noteon(channel, msg.note, msg.velocity)
         elif msg.type == 'note_off':
-            fs.noteoff(0, msg.note)
-
-    fs.delete()
+            engine.noteoff(channel, msg.note)
 
 # ---- Loop Controller ----
-def loop_playback(selected_style, stop_event):
-    loop_count = 1
+def loop_specs(selected_style):
     last_instrument = None
-
-    while not stop_event.is_set():
+    while True:
         instruments = INSTRUMENT_SETS.get(selected_style, [0])
         available_instruments = [i for i in instruments if i != last_instrument]
         instrument_program = random.choice(available_instruments) if available_instruments else random.choice(instruments)
@@ -86,21 +77,47 @@ def loop_playback(selected_style, stop_event):
 
         bpm = random.randint(80, 140)
         scale = [60, 62, 64, 65, 67, 69, 71]  # C Major scale
-        instrument_name = get_instrument_name(instrument_program)
+        yield instrument_program, bpm, scale
 
-        # Update displayed state
-        st.session_state.current_instrument = f"{instrument_name} (Program {instrument_program})"
-        st.session_state.current_bpm = bpm
+def build_loop(spec):
+    instrument_program, bpm, scale = spec
+    return instrument_program, bpm, generate_midi(bpm=bpm, scale=scale, instrument=instrument_program)
 
-        midi_filename = f"loop_{loop_count}.mid"
-        print(f"Loop {loop_count}: Style={selected_style}, Instrument={instrument_program} ({instrument_name}), BPM={bpm}")
-
-        midi_duration = generate_midi_file(midi_filename, bpm=bpm, scale=scale, instrument=instrument_program)
-        play_midi_file(midi_filename, instrument_program)
-
-        time.sleep(max(0, midi_duration))
-
-        loop_count += 1
+def loop_playback(selected_style, stop_event):
+    # Selection and generation run one loop ahead on the pipeline's workers;
+    # this thread only plays.
+    # This demo's channels on the shared synth for the whole session, with
+    # only the presets the style can pick.
+    bank = acquire_shared_bank(soundfont=programs_soundfont(INSTRUMENT_SETS.get(selected_style, [0])))
+    pipeline = Pipeline(loop_specs(selected_style), [("generate", build_loop)])
+    loop_count = 1
+    try:
+        pipeline.start()
+        while not stop_event.is_set():
+            try:
+                item = pipeline.get()
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            instrument_program, bpm, mid = item
+            instrument_name = get_instrument_name(instrument_program)
+
+            # Update displayed state
+            st.session_state.current_instrument = f"{instrument_name} (Program {instrument_program})"
+            st.session_state.current_bpm = bpm
+
+            print(f"Loop {loop_count}: Style={selected_style}, Instrument={instrument_program} ({instrument_name}), BPM={bpm}")
+
+            midi_duration = mid.length  # Actual duration in seconds
+            play_midi(mid, instrument_program, bank)
+
+            time.sleep(max(0, midi_duration))
+
+            loop_count += 1
+    finally:
+        pipeline.stop()
+        bank.release()
 
 # ---- Streamlit UI ----
 st.title("🎵 Continuous Generative Music (Seamless Loops)")
@@ -0,0 +1,109 @@
+import logging
+from collections import namedtuple
+from functools import lru_cache
+
+NOTE_TO_MIDI = {
+    'C': 0, 'C#': 1, 'Db': 1, 'D': 2, 'D#': 3, 'Eb': 3, 'E': 4,
+    'F': 5, 'F#': 6, 'Gb': 6, 'G': 7, 'G#': 8, 'Ab': 8, 'A': 9,
+    'A#': 10, 'Bb': 10, 'B': 11
+}
+
+SCALE_STEPS = {
+    "Major": (0, 2, 4, 5, 7, 9, 11),
+    "Minor": (0, 2, 3, 5, 7, 8, 10),
+    "Pentatonic": (0, 2, 4, 7, 9),
+    "Dorian": (0, 2, 3, 5, 7, 9, 10),
+    "Mixolydian": (0, 2, 4, 5, 7, 9, 10),
+    "Lydian": (0, 2, 4, 6, 7, 9, 11),
+    "Aeolian": (0, 2, 3, 5, 7, 8, 10),
+    "Phrygian": (0, 1, 3, 5, 7, 8, 10),
+    "Harmonic Minor": (0, 2, 3, 5, 7, 8, 11)
+}
+
+NUMERAL_MAP = {"I": 0, "ii": 1, "iii": 2, "IV": 3, "V": 4, "vi": 5, "vii": 6}
+
+# Named progressions offered in CHORD_PROGRESSIONS, spelled as scale degrees of
+# the loop's own scale (so "Modal Dorian" in a Dorian loop is the i-IV vamp).
+NAMED_PROGRESSIONS = {
+    "Modal Dorian": ("I", "IV"),
+    "Modal Mixolydian": ("I", "vii", "IV"),
+    "Modal Aeolian": ("I", "vi", "vii"),
+    "Lydian Static": ("I", "ii"),
+    "Dominant Cycle": ("vi", "ii", "V", "I"),
+    "Pedal Tones": ("I", "IV", "I"),
+    "Open 5ths": ("I", "V"),
+}
+
+BASE_OCTAVE = 60
+DEFAULT_SCALE = "Major"
+KEY_NAMES = tuple(NOTE_TO_MIDI)
+
+logger = logging.getLogger(__name__)
+
+# ---- Precomputed Tables ----
+# Everything below is indexed once at import for all 12 roots x all scales.
+SCALE_NOTES = {
+    (root, scale): tuple(BASE_OCTAVE + root + step for step in steps)
+    for root in range(12) for scale, steps in SCALE_STEPS.items()
+}
+
+CHORDS = {
+    (root, scale, degree): (notes[degree % len(notes)],
+                            notes[(degree + 2) % len(notes)],
+                            notes[(degree + 4) % len(notes)])
+    for (root, scale), notes in SCALE_NOTES.items() for degree in range(len(NUMERAL_MAP))
+}
+
+# Indices into the first key's scale of the notes it shares with the second key.
+COMMON_TONE_INDICES = {
+    (scale, root, other): tuple(i for i, note in enumerate(SCALE_NOTES[(root, scale)])
+                                if note in SCALE_NOTES[(other, scale)])
+    for scale in SCALE_STEPS for root in range(12) for other in range(12)
+}
+
+OTHER_KEYS = {key: tuple(k for k in KEY_NAMES if k != key) for key in KEY_NAMES}
+
+
+@lru_cache(maxsize=None)
+def key_root(key):
+    return NOTE_TO_MIDI.get(key.replace(" Minor", "").replace(" Major", ""), 0)
+
+
+def scale_name(scale):
+    return scale if scale in SCALE_STEPS else DEFAULT_SCALE
+
+
+def scale_notes(key, scale):
+    return SCALE_NOTES[(key_root(key), scale_name(scale))]
+
+
+def chord_notes(key, scale, degree):
+    return CHORDS[(key_root(key), scale_name(scale), degree)]
+
+
+def common_tone_indices(scale, key, other_key):
+    return COMMON_TONE_INDICES[(scale_name(scale), key_root(key), key_root(other_key))]
+
+
+# ---- Progression Compiler ----
+CompiledProgression = namedtuple("CompiledProgression", ["degrees", "bridges"])
+
+
+@lru_cache(maxsize=1024)
+def compile_progression(progression):
+    # "I-vi-IV-V - ii-V-I - Modal Dorian" -> one scale degree per section, with
+    # named progressions expanded instead of falling back to the I chord.
+    degrees = []
+    bridges = []
+    for token in progression.split('-'):
+        token = token.strip()
+        bridge = "bridge" in token
+        if bridge:
+            token = token.replace("bridge", "").strip()
+        numerals = NAMED_PROGRESSIONS.get(token, (token,))
+        for i, numeral in enumerate(numerals):
+            if numeral not in NUMERAL_MAP:
+                logger.warning("Unknown chord %r in progression, using I", numeral)
+            degrees.append(NUMERAL_MAP.get(numeral, 0))
+            bridges.append(bridge and i == 0)
+    return CompiledProgression(tuple(degrees), tuple(bridges))